@@ -0,0 +1,80 @@
+"""Import-time benchmark for retico-coppelia.
+
+Each scenario imports part of the package in a fresh interpreter and measures how long the import takes, and which of
+the heavy optional dependencies (OpenCV, PIL, retico_vision, ZMQ) it pulled in. The 'eager' scenario imports every
+submodule, which is what importing the package used to cost before its submodules were loaded lazily. Results are
+printed (or written to --output) as JSON.
+
+Usage:\n
+python benchmarks/bench_import.py --runs 10 --output imports.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['cv2', 'PIL.Image', 'retico_vision', 'zmq']
+
+SCENARIOS = {
+    'package': "import retico_coppelia",
+    'control': "from retico_coppelia.coppelia import CoppeliaModule",
+    'cozmo': "from retico_coppelia.coppelia_cozmo import CoppeliaCozmoModule",
+    'camera': "from retico_coppelia.coppelia_camera import CoppeliaCameraModule",
+    'eager': "import retico_coppelia\nfor name in retico_coppelia.__all__: getattr(retico_coppelia, name)",
+}
+
+_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+exec(compile(sys.argv[1], '<scenario>', 'exec'))
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'loaded': [name for name in sys.argv[2:] if name in sys.modules]}))
+"""
+
+
+def run_scenario(statement):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    out = subprocess.run([sys.executable, '-c', _CHILD, statement, *HEAVY_MODULES], env=env, capture_output=True,
+                         text=True)
+    if out.returncode != 0:
+        return {'error': out.stderr.strip().splitlines()[-1]}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def bench_scenario(name, statement, runs):
+    # The first run warms the file system and bytecode caches
+    run_scenario(statement)
+    samples = []
+    for _ in range(runs):
+        result = run_scenario(statement)
+        if 'error' in result:
+            return {'scenario': name, 'error': result['error']}
+        samples.append(result['seconds'])
+    return {'scenario': name, 'statement': statement, 'median_ms': statistics.median(samples) * 1000,
+            'min_ms': min(samples) * 1000, 'max_ms': max(samples) * 1000, 'loaded': result['loaded']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time benchmark for retico-coppelia.")
+    parser.add_argument('--runs', type=int, default=10, help="Fresh interpreters to time each scenario in.")
+    parser.add_argument('--output', help="File to write the JSON results to instead of stdout.")
+    args = parser.parse_args()
+
+    report = {
+        'environment': {'python': sys.version.split()[0], 'platform': platform.platform()},
+        'results': [bench_scenario(name, statement, args.runs) for name, statement in SCENARIOS.items()],
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Offline benchmarks for the retico-coppelia modules.
+
+The modules talk to a FakeSim (see retico_coppelia/coppelia_fake.py) instead of CoppeliaSim, so the benchmarks run on
+any machine, without a simulator or GPU. --latency adds a fixed delay to every remote call to model the round trip to
+a real simulator. Results are printed (or written to --output) as JSON, for comparing runs against each other.
+
+Usage:\n
+python benchmarks/bench_modules.py --latency 0.0005 --duration 2 --output results.json
+"""
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+import numpy as np
+import retico_core
+from retico_coppelia.coppelia import CoppeliaModule, JointPositionIU, JointSchema, JointVector
+from retico_coppelia.coppelia_camera import CoppeliaCameraModule
+from retico_coppelia.coppelia_cozmo import Cozmo, CoppeliaCozmoIU, CoppeliaCozmoModule
+from retico_coppelia.coppelia_cozmo_state import CozmoStateModule, StateSchema
+from retico_coppelia.coppelia_cozmo_util import Degrees, DPS
+from retico_coppelia.coppelia_fake import FakeRemoteAPIClient, FakeSim
+from retico_coppelia.coppelia_metrics import metrics
+from retico_coppelia.coppelia_session import CoppeliaSession
+
+JOINT_PATHS = ["/LBRiiwa14R820/joint"] + [f"/LBRiiwa14R820/link{i}_resp/joint" for i in range(2, 8)]
+STATE_SCHEMA = StateSchema(['x', 'y', 'theta', 'head_angle', 'lift_height', 'sim_time', 'sent_at', 'is_moving'],
+                           '<ddddddd?')
+
+
+class _Sink(retico_core.AbstractConsumingModule):
+    """Records when each IU arrives, together with a reference time taken from the IU by get_sent_at."""
+
+    @staticmethod
+    def name():
+        return "Benchmark Sink"
+
+    @staticmethod
+    def description():
+        return "Records the arrival times of IUs"
+
+    @staticmethod
+    def input_ius():
+        return [retico_core.IncrementalUnit]
+
+    @staticmethod
+    def output_iu():
+        return None
+
+    def __init__(self, get_sent_at, **kwargs):
+        super().__init__(**kwargs)
+        self.get_sent_at = get_sent_at
+        self.latencies = []
+
+    def process_update(self, update_message):
+        now = time.time()
+        for iu, ut in update_message:
+            self.latencies.append(now - self.get_sent_at(iu))
+
+
+def summarize(latencies):
+    """Returns count and latency percentiles in milliseconds."""
+    if len(latencies) == 0:
+        return {'count': 0}
+    ms = np.asarray(latencies) * 1000
+    return {
+        'count': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def _session(sim):
+    return CoppeliaSession(client_factory=FakeRemoteAPIClient.factory(sim))
+
+
+def _run_for(modules, duration):
+    for module in modules:
+        module.run()
+    time.sleep(duration)
+    for module in modules:
+        module.stop()
+
+
+def bench_coppelia_module(latency, n, batch, vector):
+    """Sends n JointPositionIUs for a 7-joint arm through CoppeliaModule.process_update()."""
+    sim = FakeSim(latency=latency)
+    module = CoppeliaModule(scene='bench.ttt', batch=batch, session=_session(sim))
+    schema = JointSchema.of(JOINT_PATHS)
+    targets = np.radians(np.random.default_rng(0).uniform(-90, 90, (n, len(JOINT_PATHS))))
+
+    latencies = []
+    start = time.perf_counter()
+    for row in targets:
+        sent_at = time.perf_counter()
+        payload = JointVector(schema, row) if vector else dict(zip(JOINT_PATHS, row.tolist()))
+        iu = JointPositionIU(creator=module, payload=payload)
+        module.process_update(retico_core.UpdateMessage.from_iu(iu, retico_core.UpdateType.ADD))
+        latencies.append(time.perf_counter() - sent_at)
+    elapsed = time.perf_counter() - start
+
+    return {'benchmark': 'CoppeliaModule', 'config': {'batch': batch, 'vector': vector, 'ius': n},
+            'ius_per_s': n / elapsed, 'remote_calls_per_iu': sim.calls / n, 'latency': summarize(latencies)}
+
+
+def bench_camera_module(latency, duration, encoding, as_array, sleep_interval):
+    """Runs CoppeliaCameraModule as fast as the simulation time advances and measures frames reaching a consumer."""
+    sim = FakeSim(latency=latency, time_step=0.005)
+    session = _session(sim)
+    sim.startSimulation()
+    camera = CoppeliaCameraModule(scene='bench.ttt', sensor_path='/Vision_sensor', session=session,
+                                  encoding=encoding, as_array=as_array)
+    sink = _Sink(lambda iu: iu.created_at, sleep_interval=sleep_interval)
+    camera.subscribe(sink)
+    _run_for([camera, sink], duration)
+
+    return {'benchmark': 'CoppeliaCameraModule',
+            'config': {'encoding': encoding, 'as_array': as_array, 'resolution': list(sim.resolution)},
+            'frames_per_s': camera.frames_emitted / duration, 'frames_skipped': camera.frames_skipped,
+            'latency': summarize(sink.latencies)}
+
+
+def bench_cozmo_module(latency, n, batch):
+    """Queues n two-command CoppeliaCozmoIUs and measures how long each takes until its commands have completed."""
+    sim = FakeSim(latency=latency, time_step=0.001)
+    session = _session(sim)
+    sim.startSimulation()
+    module = CoppeliaCozmoModule(cozmo_path='/cozmo', scene='bench.ttt', session=session, batch=batch)
+    module.robot.poll_interval = 0.001
+
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def completed(sent_at):
+        with lock:
+            latencies.append(time.perf_counter() - sent_at)
+            if len(latencies) == n:
+                done.set()
+
+    start = time.perf_counter()
+    for i in range(n):
+        iu = CoppeliaCozmoIU(creator=module, iuid=i, payload={
+            'turn': [Degrees(1), DPS(1000), True],
+            'look': [0.1 * (i % 2), DPS(1000), True],
+        })
+        sent_at = time.perf_counter()
+        module.queue.append(iu)
+        futures = module.process_iu()
+        remaining = [len(futures)]
+
+        def on_done(future, sent_at=sent_at, remaining=remaining):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                completed(sent_at)
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    done.wait(60)
+    elapsed = time.perf_counter() - start
+    module.shutdown()
+
+    return {'benchmark': 'CoppeliaCozmoModule', 'config': {'batch': batch, 'ius': n},
+            'ius_per_s': len(latencies) / elapsed, 'remote_calls_per_iu': sim.calls / n,
+            'latency': summarize(latencies)}
+
+
+def bench_state_module(latency, duration, encoding, rate, sleep_interval):
+    """Publishes Cozmo states from a local ZMQ publisher and measures states reaching a consumer."""
+    sim = FakeSim(latency=latency, state_rate=rate, state_encoding=encoding, state_schema=STATE_SCHEMA)
+    session = _session(sim)
+    sim.startSimulation()
+    robot = Cozmo('/cozmo', 'bench.ttt', session=session)
+    port = 20101 if encoding == 'json' else 20102
+    state = CozmoStateModule(robot, pub_ip='localhost', port=port, encoding=encoding,
+                             schema=STATE_SCHEMA if encoding == 'struct' else None)
+    sink = _Sink(lambda iu: iu.payload['sent_at'], sleep_interval=sleep_interval)
+    state.subscribe(sink)
+    _run_for([state, sink], duration)
+    published = sim.publishers[port].published
+    sim.stopSimulation()
+
+    return {'benchmark': 'CozmoStateModule', 'config': {'encoding': encoding, 'publish_rate': rate},
+            'states_published': published, 'states_per_s': len(sink.latencies) / duration,
+            'states_dropped': state.dropped, 'latency': summarize(sink.latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the retico-coppelia modules.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every remote call.")
+    parser.add_argument('--duration', type=float, default=2.0, help="Seconds to run each streaming benchmark for.")
+    parser.add_argument('--ius', type=int, default=1000, help="IUs sent in each throughput benchmark.")
+    parser.add_argument('--sleep-interval', type=float, default=0.001,
+                        help="How long the consuming end of the pipeline sleeps when idle. retico's default is 0.2.")
+    parser.add_argument('--output', help="File to write the JSON results to instead of stdout.")
+    args = parser.parse_args()
+
+    results = []
+    for batch in (False, True):
+        for vector in (False, True):
+            results.append(bench_coppelia_module(args.latency, args.ius, batch, vector))
+    for encoding, as_array in ((None, False), (None, True), ('jpeg', True)):
+        results.append(bench_camera_module(args.latency, args.duration, encoding, as_array, args.sleep_interval))
+    for batch in (False, True):
+        results.append(bench_cozmo_module(args.latency, max(args.ius // 10, 1), batch))
+    for encoding in ('json', 'struct'):
+        results.append(bench_state_module(args.latency, args.duration, encoding, None, args.sleep_interval))
+
+    report = {
+        'environment': {'python': sys.version.split()[0], 'platform': platform.platform(), 'latency': args.latency},
+        'results': results,
+        'metrics': metrics.snapshot(),
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,39 @@
-from . import coppelia
-from . import coppelia_camera
-from . import coppelia_cozmo
-from . import coppelia_cozmo_util
\ No newline at end of file
+import importlib
+
+# The submodules are imported on first access (e.g. retico_coppelia.coppelia_camera), so that a process only pays for
+# the dependencies of the subsystems it uses. The extras listed for each are the packages it needs beyond numpy,
+# retico_core and coppeliasim-zmqremoteapi-client (which brings pyzmq); see the README.
+_SUBMODULES = {
+    'coppelia': (),
+    'coppelia_camera': ('opencv-python', 'pillow', 'retico-vision'),
+    'coppelia_cozmo': (),
+    'coppelia_cozmo_state': (),
+    'coppelia_cozmo_util': (),
+    'coppelia_util': (),
+    'coppelia_scheduler': (),
+    'coppelia_session': (),
+    'coppelia_fake': (),
+    'coppelia_metrics': (),
+    'coppelia_record': ('opencv-python', 'pillow', 'retico-vision'),
+    'coppelia_shard': (),
+    'coppelia_scene': (),
+}
+
+__all__ = list(_SUBMODULES)
+
+
+def __getattr__(name):
+    if name not in _SUBMODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    try:
+        module = importlib.import_module('.' + name, __name__)
+    except ImportError as e:
+        if not _SUBMODULES[name]:
+            raise
+        raise ImportError(f"{__name__}.{name} requires {', '.join(_SUBMODULES[name])} ({e}).") from e
+    globals()[name] = module
+    return module
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
\ No newline at end of file
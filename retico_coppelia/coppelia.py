@@ -1,5 +1,135 @@
-from coppeliasim_zmqremoteapi_client import RemoteAPIClient
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import numpy as np
 import retico_core
+from retico_coppelia.coppelia_metrics import metrics
+from retico_coppelia.coppelia_session import CoppeliaSession
+from retico_coppelia.coppelia_util import HandleCache, define_script_functions
+
+# Sets the targets of many joints in a single remote call. modes[i] is 0 for position, 1 for velocity and 2 for force.
+_SET_JOINT_TARGETS_LUA = '''
+function retico_setJointTargets(handles, values, modes)
+    for i = 1, #handles do
+        if modes[i] == 0 then
+            sim.setJointTargetPosition(handles[i], values[i])
+        elseif modes[i] == 1 then
+            sim.setJointTargetVelocity(handles[i], values[i])
+        else
+            sim.setJointTargetForce(handles[i], values[i])
+        end
+    end
+end
+'''
+
+
+class JointSchema:
+    """An ordered, immutable set of joint paths that maps each path to an index. Schemas are interned, so all IUs
+    addressing the same joints share a single schema instead of each repeating the path strings. A schema is only
+    kept while something (e.g. a JointVector) still uses it.
+
+    Example:\n
+    schema = JointSchema.of(["/arm/joint", "/arm/link2_resp/joint"])
+    """
+
+    __slots__ = ('paths', 'index', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+    _interned_lock = threading.Lock()
+
+    def __init__(self, paths):
+        self.paths = tuple(paths)
+        self.index = {path: i for i, path in enumerate(self.paths)}
+
+    @classmethod
+    def of(cls, paths):
+        """Returns the shared schema for the given joint paths, creating it on first use."""
+        if isinstance(paths, JointSchema):
+            return paths
+        paths = tuple(paths)
+        schema = cls._interned.get(paths)
+        if schema is None:
+            with cls._interned_lock:
+                schema = cls._interned.setdefault(paths, cls(paths))
+        return schema
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __repr__(self):
+        return f"JointSchema({list(self.paths)})"
+
+
+class JointVector(MutableMapping):
+    """A joint payload that stores its values in a float64 array indexed by a shared JointSchema. It supports the same
+    dict API as the plain {joint_path: value} payloads, so it can be used as the payload of JointPositionIU,
+    JointVelocityIU and JointForceIU.
+
+    Example:\n
+    iu = JointPositionIU(payload=JointVector(schema, np.radians([30, 45])))
+    """
+
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values=None):
+        """
+        :param schema: A JointSchema or a list of joint paths, which is interned.
+        :param values: The value of every joint in schema order. Defaults to zeros.
+        """
+        self.schema = JointSchema.of(schema)
+        if values is None:
+            self.values = np.zeros(len(self.schema))
+        else:
+            self.values = np.array(values, dtype=np.float64).reshape(len(self.schema))
+
+    @classmethod
+    def from_dict(cls, payload):
+        """Creates a JointVector from a {joint_path: value} dict."""
+        return cls(payload.keys(), list(payload.values()))
+
+    def __getitem__(self, path):
+        return float(self.values[self.schema.index[path]])
+
+    def __setitem__(self, path, value):
+        i = self.schema.index.get(path)
+        if i is None:
+            self.schema = JointSchema.of(self.schema.paths + (path,))
+            self.values = np.append(self.values, value)
+        else:
+            self.values[i] = value
+
+    def __delitem__(self, path):
+        i = self.schema.index[path]
+        self.schema = JointSchema.of(self.schema.paths[:i] + self.schema.paths[i + 1:])
+        self.values = np.delete(self.values, i)
+
+    def __contains__(self, path):
+        return path in self.schema.index
+
+    def __iter__(self):
+        return iter(self.schema.paths)
+
+    def __len__(self):
+        return len(self.schema)
+
+    def items(self):
+        return list(zip(self.schema.paths, self.values.tolist()))
+
+    def set_values(self, paths, values):
+        """Sets the values of several joints, writing straight into the array if paths match the schema."""
+        if paths is self.schema.paths or tuple(paths) == self.schema.paths:
+            self.values[:] = values
+        else:
+            for path, value in zip(paths, values):
+                self[path] = value
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"JointVector({self.to_dict()})"
 
 
 class JointForceIU(retico_core.abstract.IncrementalUnit):
@@ -19,7 +149,10 @@ class JointForceIU(retico_core.abstract.IncrementalUnit):
         self.payload[joint_path] = force
 
     def set_multi_force(self, list_of_joint_paths, list_of_forces):
-        for path, force in list(zip(list_of_joint_paths, list_of_forces)):
+        if isinstance(self.payload, JointVector):
+            self.payload.set_values(list_of_joint_paths, list_of_forces)
+            return
+        for path, force in zip(list_of_joint_paths, list_of_forces):
             self.payload[path] = force
 
     def __str__(self):
@@ -43,7 +176,10 @@ class JointVelocityIU(retico_core.abstract.IncrementalUnit):
         self.payload[joint_path] = vel
 
     def set_multi_velocity(self, list_of_joint_paths, list_of_velocities):
-        for path, vel in list(zip(list_of_joint_paths, list_of_velocities)):
+        if isinstance(self.payload, JointVector):
+            self.payload.set_values(list_of_joint_paths, list_of_velocities)
+            return
+        for path, vel in zip(list_of_joint_paths, list_of_velocities):
             self.payload[path] = vel
 
     def __str__(self):
@@ -67,13 +203,154 @@ class JointPositionIU(retico_core.abstract.IncrementalUnit):
         self.payload[joint_path] = pos
 
     def set_multi_position(self, list_of_joint_paths, list_of_positions):
-        for path, pos in list(zip(list_of_joint_paths, list_of_positions)):
+        if isinstance(self.payload, JointVector):
+            self.payload.set_values(list_of_joint_paths, list_of_positions)
+            return
+        for path, pos in zip(list_of_joint_paths, list_of_positions):
             self.payload[path] = pos
 
     def __str__(self):
         return f"(JointPositionIU: {self.payload.items()})"
 
 
+class JointTrajectoryIU(retico_core.abstract.IncrementalUnit):
+    """A whole motion of several joints as time-stamped waypoints, which CoppeliaModule executes by interpolating
+    between them and streaming the resulting targets at its control rate.
+
+    Example:\n
+    iu.set_trajectory(["/arm/joint", "/arm/link2_resp/joint"], times=[0.0, 1.0, 2.0],\n
+                      targets=np.radians([[0, 0], [30, 45], [0, 0]]))
+    """
+
+    @staticmethod
+    def type():
+        return "JointTrajectoryIU"
+
+    def __init__(self, creator=None, iuid=0, previous_iu=None, grounded_in=None, payload: dict=None, **kwargs):
+        super().__init__(creator=creator, iuid=iuid, previous_iu=previous_iu, grounded_in=grounded_in, payload=payload)
+        self.payload = {}
+        if payload is not None:
+            self.set_trajectory(**payload)
+
+    def set_trajectory(self, joint_paths, times, targets, mode=0):
+        """
+        :param joint_paths: The paths of the joints moved by the trajectory.
+        :param times: The increasing times of the waypoints in seconds, relative to the start of the trajectory.
+        :param targets: An array of shape (len(times), len(joint_paths)) holding the target of every joint at every
+        waypoint.
+        :param mode: 0 if the targets are positions, 1 for velocities or 2 for forces.
+        """
+        times = np.asarray(times, dtype=float)
+        targets = np.asarray(targets, dtype=float).reshape(len(times), len(joint_paths))
+        if len(times) < 1 or np.any(np.diff(times) <= 0):
+            raise Exception("A trajectory needs at least one waypoint, with strictly increasing times.")
+        self.payload = {"joint_paths": list(joint_paths), "times": times, "targets": targets, "mode": mode}
+
+    @property
+    def duration(self):
+        return self.payload["times"][-1]
+
+    def sample(self, t):
+        """Returns the targets of all joints at t seconds into the trajectory, linearly interpolated between the
+        surrounding waypoints and held at the first and last waypoint outside of them."""
+        times, targets = self.payload["times"], self.payload["targets"]
+        k = np.searchsorted(times, t)
+        if k <= 0:
+            return targets[0]
+        if k >= len(times):
+            return targets[-1]
+        w = (t - times[k - 1]) / (times[k] - times[k - 1])
+        return targets[k - 1] + w * (targets[k] - targets[k - 1])
+
+    def __str__(self):
+        return f"(JointTrajectoryIU: {len(self.payload.get('times', []))} waypoints for " \
+               f"{self.payload.get('joint_paths', [])})"
+
+
+_JOINT_MODES = {JointPositionIU: 0, JointVelocityIU: 1, JointForceIU: 2}
+_JOINT_SETTERS = ("setJointTargetPosition", "setJointTargetVelocity", "setJointTargetForce")
+
+
+class JointCommandBuffer:
+    """A bounded, latest-wins buffer of pending joint targets.
+
+    At most one target is held per joint and mode (position, velocity or force). A newer target for the same joint and
+    mode supersedes the pending one, and when the buffer is full the oldest pending target is dropped.
+    """
+
+    def __init__(self, maxlen=256):
+        self.maxlen = maxlen
+        self.superseded = 0
+        self.dropped = 0
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, path, mode, value):
+        """Buffers a single joint target.
+
+        :param path: The path of the joint within the scene.
+        :param mode: 0 for position, 1 for velocity or 2 for force.
+        :param value: The target value.
+        """
+        key = (path, mode)
+        with self._lock:
+            if key in self._pending:
+                # Re-inserting keeps the flush order in line with the arrival order of the latest targets
+                del self._pending[key]
+                self.superseded += 1
+            elif len(self._pending) >= self.maxlen:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            self._pending[key] = value
+
+    def put_many(self, paths, mode, values):
+        """Buffers the targets of several distinct joints at once, with the same outcome as calling put() for each.
+
+        :param paths: The paths of the joints.
+        :param mode: 0 for position, 1 for velocity or 2 for force.
+        :param values: The target values, in the order of paths.
+        """
+        keys = [(path, mode) for path in paths]
+        with self._lock:
+            pending = self._pending
+            if len(pending) > 0:
+                for key in keys:
+                    if key in pending:
+                        del pending[key]
+                        self.superseded += 1
+            pending.update(zip(keys, values))
+            overflow = len(pending) - self.maxlen
+            if overflow > 0:
+                for _ in range(overflow):
+                    pending.popitem(last=False)
+                self.dropped += overflow
+
+    def put_iu(self, iu):
+        """Buffers all joint targets of a JointPositionIU, JointVelocityIU or JointForceIU, whose payload may be a dict
+        or a JointVector."""
+        mode = _JOINT_MODES.get(type(iu))
+        if mode is None: return
+
+        payload = iu.payload
+        if isinstance(payload, JointVector):
+            self.put_many(payload.schema.paths, mode, payload.values.tolist())
+        else:
+            self.put_many(payload.keys(), mode, payload.values())
+
+    def drain(self):
+        """Empties the buffer.
+
+        :return: A list of (path, mode, value) tuples, oldest first.
+        """
+        with self._lock:
+            commands = [(path, mode, value) for (path, mode), value in self._pending.items()]
+            self._pending.clear()
+        return commands
+
+    def __len__(self):
+        return len(self._pending)
+
+
 class CoppeliaModule(retico_core.AbstractConsumingModule):
 
     @staticmethod
@@ -86,48 +363,191 @@ class CoppeliaModule(retico_core.AbstractConsumingModule):
 
     @staticmethod
     def input_ius():
-        return [JointPositionIU, JointVelocityIU, JointForceIU]
+        return [JointPositionIU, JointVelocityIU, JointForceIU, JointTrajectoryIU]
 
     @staticmethod
     def output_iu():
         return None
 
-    def __init__(self, scene, start_scene=False, **kwargs):
+    def __init__(self, scene, start_scene=False, joint_paths=None, batch=False, max_pending=256, stepped=False,
+                 session=None, control_rate=50.0, host='localhost', port=23000, **kwargs):
+        """
+        :param scene: The scene file to load if start_scene is True.
+        :param start_scene: Whether this module should load the scene (unless it is loaded already) and start (and on
+        shutdown stop) the simulation. See SceneManager.
+        :param joint_paths: An optional list of joint paths whose handles are resolved up front.
+        :param batch: If True, all pending joint targets are sent to the simulator in a single remote call instead of
+        one call per joint.
+        :param max_pending: The maximum number of joint targets held between flushes. See JointCommandBuffer.
+        :param stepped: If True, incoming targets are only buffered and are sent when flush() is called, e.g. by a
+        CoppeliaStepScheduler before each simulation step.
+        :param session: The CoppeliaSession to talk to the simulator through. By default, the session shared
+        for host and port (see CoppeliaSession.shared()), so that modules share its scene manager.
+        :param control_rate: How many times per second the targets of running JointTrajectoryIUs are sent. In stepped
+        mode, trajectories follow the simulation time and are sampled on every flush() instead.
+        :param host: The host of the CoppeliaSim instance to connect to if no session is given.
+        :param port: The port of that instance's ZMQ remote API server.
+        """
         super().__init__(**kwargs)
 
         self.start_scene = start_scene
-        self.client = RemoteAPIClient()
-        self.sim = self.client.require('sim')
-        self.sim.loadScene(scene)
-        self.queue = []
+        self.batch = batch
+        self.stepped = stepped
+        self.session = session if session is not None else CoppeliaSession.shared(host, port)
+        self.sim = self.session.sim
+        if self.start_scene:
+            self.session.scenes.load(scene)
+        self.handles = HandleCache(self.sim, joint_paths)
+        self.session.scenes.add_listener(self._on_scene_loaded)
+        self.commands = JointCommandBuffer(max_pending)
+        self.control_rate = control_rate
+
+        self._pending_since = None
+        labels = {'module': self.name(), 'instance': metrics.instance(self)}
+        self._rpc_time = metrics.histogram('coppelia_rpc_seconds', "Time spent sending joint targets", owner=self,
+                                           **labels)
+        self._actuation_latency = metrics.histogram('coppelia_actuation_latency_seconds',
+                                                    "Time from the first pending target arriving to it being sent",
+                                                    owner=self, **labels)
+        metrics.counter('coppelia_targets_superseded', "Targets replaced by a newer one before being sent",
+                        fn=lambda m: m.commands.superseded, owner=self, **labels)
+        metrics.counter('coppelia_targets_dropped', "Targets dropped because the buffer was full",
+                        fn=lambda m: m.commands.dropped, owner=self, **labels)
+        metrics.gauge('coppelia_targets_pending', "Targets waiting to be sent", fn=lambda m: len(m.commands),
+                      owner=self, **labels)
+
+        # id(JointTrajectoryIU) -> (JointTrajectoryIU, start time). IUs default to iuid 0, so their ids can't be keys
+        self._trajectories = OrderedDict()
+        self._trajectory_lock = threading.Lock()
+        self._player = None
+
+        self._batch_script = None
+        if self.batch:
+            self._batch_script = define_script_functions(self.sim, _SET_JOINT_TARGETS_LUA)
 
         if self.start_scene:
-            print("Starting simulation...")
-            self.sim.startSimulation()
+            self.session.scenes.start()
+
+    def _on_scene_loaded(self, scene):
+        self.handles.invalidate()
 
     def process_update(self, update_message):
         for iu, um in update_message:
-            if um == retico_core.abstract.UpdateType.ADD:
-                self.queue.append(iu)
-        self.process_iu()
-
-    def process_iu(self):
-        if len(self.queue) < 1: return
-
-        iu = self.queue.pop()
-        if type(iu) is JointForceIU:
-            for path, force in iu.payload.items():
-                handle = self.sim.getObject(path)
-                self.sim.setJointTargetForce(handle, force)
-        elif type(iu) is JointVelocityIU:
-            for path, vel in iu.payload.items():
-                handle = self.sim.getObject(path)
-                self.sim.setJointTargetVelocity(handle, vel)
-        elif type(iu) is JointPositionIU:
-            for path, pos in iu.payload.items():
-                handle = self.sim.getObject(path)
-                self.sim.setJointTargetPosition(handle, pos)
+            if isinstance(iu, JointTrajectoryIU):
+                if um == retico_core.abstract.UpdateType.ADD:
+                    self.play(iu)
+                elif um == retico_core.abstract.UpdateType.REVOKE:
+                    self.cancel(iu)
+            elif um == retico_core.abstract.UpdateType.ADD:
+                if self._pending_since is None:
+                    self._pending_since = time.perf_counter()
+                self.commands.put_iu(iu)
+
+        if not self.stepped:
+            self.flush()
+
+    def play(self, iu):
+        """Starts executing a JointTrajectoryIU. Its interpolated targets are streamed at the control rate by a
+        background thread or, in stepped mode, sampled at the current simulation time on every flush(). A later
+        trajectory for the same joints takes precedence over an earlier one that is still running.
+        """
+        start = self.sim.getSimulationTime() if self.stepped else time.perf_counter()
+        with self._trajectory_lock:
+            self._trajectories[id(iu)] = (iu, start)
+            if self.stepped or (self._player is not None and self._player.is_alive()): return
+            self._player = threading.Thread(target=self._play_trajectories, daemon=True)
+            self._player.start()
+
+    def cancel(self, iu):
+        """Stops a running JointTrajectoryIU, leaving its joints at their latest targets."""
+        with self._trajectory_lock:
+            self._trajectories.pop(id(iu), None)
+
+    def _sample_trajectories(self, now):
+        """Buffers the targets of all running trajectories at time now and drops the finished ones."""
+        with self._trajectory_lock:
+            for key, (iu, start) in list(self._trajectories.items()):
+                t = now - start
+                self.commands.put_many(iu.payload["joint_paths"], iu.payload["mode"], iu.sample(t).tolist())
+                if t >= iu.duration:
+                    del self._trajectories[key]
+            return len(self._trajectories) > 0
+
+    def _play_trajectories(self):
+        period = 1 / self.control_rate
+        next_tick = time.perf_counter()
+        while True:
+            running = self._sample_trajectories(time.perf_counter())
+            self.flush()
+            if not running:
+                with self._trajectory_lock:
+                    # A trajectory may have been added since sampling; keep playing it
+                    if len(self._trajectories) == 0:
+                        self._player = None
+                        return
+
+            next_tick += period
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.perf_counter()
+
+    def flush(self):
+        """Sends the most recent pending target of every joint to the simulator."""
+        if self.stepped and len(self._trajectories) > 0:
+            self._sample_trajectories(self.sim.getSimulationTime())
+
+        pending_since, self._pending_since = self._pending_since, None
+        commands = self.commands.drain()
+        if len(commands) < 1: return
+
+        start = time.perf_counter()
+        if self.batch:
+            self._flush_batch(commands)
+        else:
+            for path, mode, value in commands:
+                self._set_joint_target(getattr(self.sim, _JOINT_SETTERS[mode]), path, value)
+        end = time.perf_counter()
+        self._rpc_time.observe(end - start)
+        if pending_since is not None:
+            self._actuation_latency.observe(end - pending_since)
+
+    def _flush_batch(self, commands):
+        try:
+            self._send_batch(commands)
+        except Exception:
+            # See _set_joint_target(); retry once with freshly resolved handles
+            for path, _, _ in commands:
+                self.handles.invalidate(path)
+            self._send_batch(commands)
+
+    def _send_batch(self, commands):
+        handles = [self.handles.get(path) for path, _, _ in commands]
+        values = [value for _, _, value in commands]
+        modes = [mode for _, mode, _ in commands]
+        self.sim.callScriptFunction("retico_setJointTargets", self._batch_script, handles, values, modes)
+
+    def _set_joint_target(self, setter, path, value):
+        try:
+            setter(self.handles.get(path), value)
+        except Exception:
+            # The cached handle may be stale if the object was removed or the scene reloaded behind our back
+            self.handles.invalidate(path)
+            setter(self.handles.get(path), value)
+
+    def load_scene(self, scene):
+        """Loads a scene into the simulator, even if it is loaded already. All modules sharing the session drop the
+        handles they have cached."""
+        self.session.scenes.load(scene, force=True)
+
+    def remove_object(self, path):
+        """Removes the object at path from the scene and drops its cached handle."""
+        self.sim.removeObjects([self.handles.get(path)])
+        self.handles.invalidate(path)
 
     def shutdown(self):
+        with self._trajectory_lock:
+            self._trajectories.clear()
         if self.start_scene:
-            self.sim.stopSimulation()
\ No newline at end of file
+            self.session.scenes.stop()
\ No newline at end of file
@@ -1,11 +1,155 @@
+import base64
+import datetime
+import json
 import threading
+import time
+import zlib
 import cv2
 import numpy as np
 from PIL import Image
-from coppeliasim_zmqremoteapi_client import RemoteAPIClient
 import retico_core
+from retico_coppelia.coppelia_metrics import metrics
+from retico_coppelia.coppelia_session import CoppeliaSession
+from retico_coppelia.coppelia_util import define_script_functions
 from retico_vision.vision import ImageIU
 
+# Reads several vision sensors in a single remote call. Script function calls are served between simulation steps, so
+# all images belong to the same step, whose simulation time is returned along with them.
+_GET_VISION_SENSOR_IMGS_LUA = '''
+function retico_getVisionSensorImgs(handles, options, positions, sizes)
+    local images, resolutions = {}, {}
+    for i = 1, #handles do
+        images[i], resolutions[i] = sim.getVisionSensorImg(handles[i], options, 0.0, positions[i], sizes[i])
+    end
+    return images, resolutions, sim.getSimulationTime()
+end
+'''
+
+
+class FrameBuffers:
+    """Rings of preallocated frame arrays that are reused round-robin, so that capturing a frame doesn't allocate. There
+    is one ring per frame shape, e.g. one for captured and one for resized frames."""
+
+    def __init__(self, count):
+        self.count = count
+        self._rings = {}
+
+    def next(self, shape):
+        """Returns the next buffer of the given shape, allocating a ring for the shape on first use."""
+        ring = self._rings.get(shape)
+        if ring is None:
+            ring = [[np.empty(shape, dtype=np.uint8) for _ in range(self.count)], 0]
+            self._rings[shape] = ring
+
+        buffers, i = ring
+        ring[1] = (i + 1) % self.count
+        return buffers[i]
+
+
+def convert_frame(img_buffer, res, frames):
+    """Turns a raw vision sensor buffer into an upright frame with swapped channel order, copying it only once.
+
+    :param img_buffer: The image buffer returned by sim.getVisionSensorImg().
+    :param res: The resolution returned by sim.getVisionSensorImg().
+    :param frames: The FrameBuffers to take the output array from.
+    :return: A numpy array of shape (height, width, 3), or (height, width) for greyscale images.
+    """
+    raw = np.frombuffer(img_buffer, dtype=np.uint8).reshape(res[1], res[0], -1)
+    # Flipping rows and swapping channels through negative strides is a view, so copyto() is the only copy
+    if raw.shape[2] == 1:
+        view = raw[::-1, :, 0]
+    else:
+        view = raw[::-1, :, ::-1]
+    img = frames.next(view.shape)
+    np.copyto(img, view)
+    return img
+
+
+class EncodedImageIU(ImageIU):
+    """An ImageIU whose image is a JPEG or PNG encoded frame.
+
+    Attributes:
+        image (bytes): The encoded frame
+        encoding (str): Either 'jpeg' or 'png'
+    """
+
+    @staticmethod
+    def type():
+        return "Encoded Image IU"
+
+    def __init__(self, creator=None, iuid=0, previous_iu=None, grounded_in=None, rate=None, nframes=None,
+                 image=None, encoding=None, **kwargs):
+        super().__init__(creator=creator, iuid=iuid, previous_iu=previous_iu, grounded_in=grounded_in, rate=rate,
+                         nframes=nframes, image=image)
+        self.encoding = encoding
+
+    def decode(self):
+        """Decodes the frame.
+
+        :return: A numpy array with the same layout the camera module emits with as_array=True.
+        """
+        return cv2.imdecode(np.frombuffer(self.image, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+    def to_zmq(self, update_type):
+        """Returns a message for retico-zmq with the encoded frame as base64, instead of ImageIU's list of pixels."""
+        message = {
+            'image': base64.b64encode(self.image).decode('ascii'),
+            'encoding': self.encoding,
+            'nframes': self.nframes,
+            'rate': self.rate,
+        }
+        return {
+            'originatingTime': datetime.datetime.now().isoformat(),
+            'update_type': str(update_type),
+            'message': json.dumps(message),
+        }
+
+    def from_zmq(self, zmq_data):
+        message = json.loads(zmq_data['message'])
+        self.image = base64.b64decode(message['image'])
+        self.payload = self.image
+        self.encoding = message['encoding']
+        self.nframes = message['nframes']
+        self.rate = message['rate']
+
+
+class MultiImageIU(ImageIU):
+    """An ImageIU holding one frame per vision sensor, all captured during the same simulation step.
+
+    Attributes:
+        images (dict): The frames of this IU, keyed by sensor path
+        image: The frame of the first sensor, for consumers that only expect a single image
+        encoding (str): 'jpeg' or 'png' if the frames are encoded (see EncodedImageIU), otherwise None
+    """
+
+    @staticmethod
+    def type():
+        return "Multi Image IU"
+
+    def __init__(self, creator=None, iuid=0, previous_iu=None, grounded_in=None, rate=None, nframes=None,
+                 images=None, encoding=None, **kwargs):
+        super().__init__(creator=creator, iuid=iuid, previous_iu=previous_iu, grounded_in=grounded_in, rate=rate,
+                         nframes=nframes)
+        self.images = images if images is not None else {}
+        self.encoding = encoding
+
+    def decode(self):
+        """Decodes the frames of an IU with encoded frames.
+
+        :return: A dict pairing sensor paths with numpy arrays, laid out as with as_array=True.
+        """
+        return {path: cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+                for path, image in self.images.items()}
+
+    def set_images(self, images, nframes, rate):
+        """Sets the frames of the IU.
+
+        :param images: A dict pairing sensor paths with frames.
+        """
+        self.set_image(next(iter(images.values()), None), nframes, rate)
+        self.images = images
+        self.payload = images
+
 
 class CoppeliaCameraModule(retico_core.AbstractProducingModule):
 
@@ -21,55 +165,210 @@ class CoppeliaCameraModule(retico_core.AbstractProducingModule):
     def input_ius():
         return None
 
-    @staticmethod
-    def output_iu():
-        return ImageIU
+    def output_iu(self):
+        return EncodedImageIU if self.encoding is not None else ImageIU
 
-    def __init__(self, scene, start_scene=False, sensor_path=None, visualizer=False, **kwargs):
+    def __init__(self, scene, start_scene=False, sensor_path=None, visualizer=False, stepped=False, session=None,
+                 as_array=False, frame_buffers=3, fps=None, require_sim_advance=True, skip_duplicates=False,
+                 idle_interval=0.005, roi=None, grayscale=False, resize=None, encoding=None, quality=None, host='localhost',
+                 port=23000, **kwargs):
+        """
+        :param scene: The scene file to load if start_scene is True.
+        :param start_scene: Whether this module should load and start (and on shutdown stop) the simulation.
+        :param sensor_path: The path of the vision sensor within the scene.
+        :param visualizer: Whether to show the captured frames in an OpenCV window.
+        :param stepped: If True, no capture thread is started and frames are only captured when capture() is called,
+        e.g. by a CoppeliaStepScheduler after each simulation step.
+        :param session: The CoppeliaSession to talk to the simulator through. By default, the session shared
+        for host and port (see CoppeliaSession.shared()), so that modules share its scene manager.
+        :param as_array: If True, ImageIUs carry the frame as a numpy array instead of a PIL image, which saves a copy
+        per frame. The arrays are taken from a ring of frame_buffers preallocated buffers, so a consumer that keeps a
+        frame for longer than the following frame_buffers - 1 frames must copy it.
+        :param frame_buffers: The number of preallocated frame buffers used when as_array is True.
+        :param fps: The maximum number of frames per second the capture thread grabs. If None, frames are grabbed as
+        fast as the simulator delivers them.
+        :param require_sim_advance: If True, a frame is only produced when the simulation time has advanced since the
+        last one, so a paused or not yet stepped simulation doesn't produce repeated frames.
+        :param skip_duplicates: If True, frames whose content is identical to the previous frame are dropped.
+        :param idle_interval: How long the capture thread sleeps after a skipped frame when fps is None.
+        :param roi: An optional region of interest (x, y, width, height) in pixels, with (0, 0) being the top left
+        corner of the image. Only this region is transferred from the simulator.
+        :param grayscale: If True, the simulator returns single channel greyscale images.
+        :param resize: An optional (width, height) to scale frames to after cropping.
+        :param encoding: 'jpeg' or 'png' to emit compressed frames as EncodedImageIUs instead of raw ImageIUs.
+        :param quality: The JPEG quality (0 to 100, default 95) or PNG compression level (0 to 9, default 3).
+        :param host: The host of the CoppeliaSim instance to connect to if no session is given.
+        :param port: The port of that instance's ZMQ remote API server.
+        """
         super().__init__(**kwargs)
 
         if sensor_path is None:
             raise Exception("No CoppeliaSim sensor path specified.")
+        if encoding not in (None, 'jpeg', 'png'):
+            raise Exception(f"Invalid encoding {encoding}.")
 
         self.start_scene = start_scene
         self.sensor_path = sensor_path
         self._vision_loop_active = False
+        self._handle = None
+        self._read_args = []
         self.visualizer = visualizer
+        self.stepped = stepped
+        self.as_array = as_array
+        self.fps = fps
+        self.require_sim_advance = require_sim_advance
+        self.skip_duplicates = skip_duplicates
+        self.idle_interval = idle_interval
+        self.roi = roi
+        self.grayscale = grayscale
+        self.resize = tuple(resize) if resize is not None else None
+        self.encoding = encoding
+        self.quality = quality
+        self.frames_emitted = 0
+        self.frames_skipped = 0
+        self._last_sim_time = None
+        self._last_digest = None
+        # The encoders and _to_payload() copy the frame out, so otherwise a single scratch buffer is enough
+        self._frames = FrameBuffers(frame_buffers if as_array and encoding is None else 1)
 
-        self.client = RemoteAPIClient()
-        self.sim = self.client.require('sim')
+        self.session = session if session is not None else CoppeliaSession.shared(host, port)
+        self.sim = self.session.sim
+        self._init_metrics()
+        self.session.scenes.add_listener(self._on_scene_loaded)
 
         if start_scene:
-            self.sim.loadScene(scene)
-            self.sim.startSimulation()
+            self.session.scenes.load(scene)
+            self.session.scenes.start()
 
     def process_update(self, um):
         return None
 
-    def _vision_loop(self):
-        handle = self.sim.getObject(self.sensor_path)
-        while self._vision_loop_active:
-            img_buffer, res = self.sim.getVisionSensorImg(handle)
-            img = np.frombuffer(img_buffer, dtype=np.uint8).reshape(res[1], res[0], 3)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            img = cv2.flip(img, 0)
+    def _on_scene_loaded(self, scene):
+        # The sensor is looked up again on the next capture
+        self._handle = None
+        self._last_sim_time = None
 
-            if self.visualizer:
-                cv2.imshow(self.sensor_path, img)
+    def _metrics_sensor(self):
+        return self.sensor_path
 
-                k = cv2.waitKey(1) & 0xFF
-                if k == 27:
-                    cv2.destroyAllWindows()
-                    break
+    def _init_metrics(self):
+        labels = {'module': self.name(), 'sensor': self._metrics_sensor(), 'instance': metrics.instance(self)}
+        self._rpc_time = metrics.histogram('coppelia_camera_rpc_seconds', "Time spent reading vision sensor images",
+                                           owner=self, **labels)
+        self._convert_time = metrics.histogram('coppelia_camera_convert_seconds',
+                                               "Time spent converting and encoding frames", owner=self, **labels)
+        self._emit_latency = metrics.histogram('coppelia_camera_capture_to_emit_seconds',
+                                               "Time from reading a frame to appending its IU", owner=self, **labels)
+        metrics.counter('coppelia_camera_frames_emitted', "Frames appended as IUs", fn=lambda m: m.frames_emitted,
+                        owner=self, **labels)
+        metrics.counter('coppelia_camera_frames_skipped', "Frames skipped as unchanged",
+                        fn=lambda m: m.frames_skipped, owner=self, **labels)
 
-            frame = Image.fromarray(img)
-            output_iu = self.create_iu()
-            output_iu.set_image(frame, 1, -1)
+    def capture(self):
+        """Grabs the current image of the vision sensor and appends it to the output as an ImageIU. The simulation time
+        of the frame is stored in the IU's meta_data under 'sim_time'.
+
+        :return: True if a frame was produced, False if it was skipped or the visualizer window was closed.
+        """
+        if self._handle is None:
+            self._handle = self.sim.getObject(self.sensor_path)
+            self._read_args = self._sensor_read_args(self._handle)
+
+        sim_time = self.sim.getSimulationTime() if self.require_sim_advance else None
+        if sim_time is not None and sim_time == self._last_sim_time:
+            self.frames_skipped += 1
+            return False
+
+        start = time.perf_counter()
+        img_buffer, res = self.sim.getVisionSensorImg(self._handle, *self._read_args)
+        self._rpc_time.observe(time.perf_counter() - start)
+        if self.skip_duplicates:
+            digest = zlib.crc32(img_buffer)
+            if digest == self._last_digest:
+                self.frames_skipped += 1
+                return False
+            self._last_digest = digest
+        self._last_sim_time = sim_time
+
+        converting = time.perf_counter()
+        img = self._process_frame(img_buffer, res, self._frames)
+
+        if self.visualizer:
+            cv2.imshow(self.sensor_path, img)
 
-            update_message = retico_core.UpdateMessage.from_iu(output_iu, retico_core.UpdateType.ADD)
-            self.append(update_message)
+            k = cv2.waitKey(1) & 0xFF
+            if k == 27:
+                cv2.destroyAllWindows()
+                self._vision_loop_active = False
+                return False
+
+        frame = self._to_payload(img)
+        self._convert_time.observe(time.perf_counter() - converting)
+        output_iu = self.create_iu()
+        output_iu.set_image(frame, 1, self.fps if self.fps is not None else -1)
+        output_iu.meta_data['sim_time'] = sim_time
+        if self.encoding is not None:
+            output_iu.encoding = self.encoding
+
+        update_message = retico_core.UpdateMessage.from_iu(output_iu, retico_core.UpdateType.ADD)
+        self.append(update_message)
+        self._emit_latency.observe(time.perf_counter() - start)
+        self.frames_emitted += 1
+        return True
+
+    def _sensor_read_args(self, handle):
+        """Returns the extra arguments to sim.getVisionSensorImg() that apply grayscale and roi on the simulator side."""
+        options = 1 if self.grayscale else 0
+        if self.roi is None:
+            return [options] if options else []
+
+        x, y, width, height = self.roi
+        res = self.sim.getVisionSensorRes(handle)
+        # The simulator counts rows from the bottom of the image
+        return [options, 0.0, [x, res[1] - y - height], [width, height]]
+
+    def _process_frame(self, img_buffer, res, frames):
+        img = convert_frame(img_buffer, res, frames)
+        if self.resize is not None:
+            dst = frames.next((self.resize[1], self.resize[0]) + img.shape[2:])
+            img = cv2.resize(img, self.resize, dst=dst, interpolation=cv2.INTER_AREA)
+        return img
+
+    def _to_payload(self, img):
+        if self.encoding == 'jpeg':
+            quality = self.quality if self.quality is not None else 95
+            return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+        elif self.encoding == 'png':
+            quality = self.quality if self.quality is not None else 3
+            return cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, quality])[1].tobytes()
+        elif self.as_array:
+            return img
+        elif img.ndim == 2:
+            # PIL copies RGB arrays into its own storage, but wraps greyscale ones, which would share the scratch buffer
+            return Image.fromarray(img.copy())
+        return Image.fromarray(img)
+
+    def _vision_loop(self):
+        interval = 1.0 / self.fps if self.fps else None
+        next_capture = time.perf_counter()
+        while self._vision_loop_active:
+            captured = self.capture()
+
+            if interval is None:
+                if not captured:
+                    time.sleep(self.idle_interval)
+                continue
+
+            next_capture += interval
+            delay = next_capture - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:  # Fell behind; don't try to catch up with a burst of frames
+                next_capture = time.perf_counter()
 
     def setup(self):
+        if self.stepped: return
+
         self._vision_loop_active = True
         t = threading.Thread(target=self._vision_loop)
         t.start()
@@ -77,7 +376,129 @@ class CoppeliaCameraModule(retico_core.AbstractProducingModule):
     def shutdown(self):
         self._vision_loop_active = False
 
-        cv2.destroyAllWindows()
+        if self.visualizer:  # Headless OpenCV builds can't destroy windows
+            cv2.destroyAllWindows()
 
         if self.start_scene:
-            self.sim.stopSimulation()
\ No newline at end of file
+            self.session.scenes.stop()
+
+
+class CoppeliaMultiCameraModule(CoppeliaCameraModule):
+    """A camera module that captures several vision sensors in one loop, with a single remote call per capture.
+
+    All frames of a capture belong to the same simulation step and are tagged as one set: each IU's meta_data holds
+    the 'sensor_path', the 'sim_time' and a 'frame_set' number shared by all frames of the set. Frames are either
+    emitted as one ImageIU per sensor in a single update message, or, with combined=True, as a single MultiImageIU.
+    The output options (roi, grayscale, resize, encoding) apply to every sensor.
+    """
+
+    @staticmethod
+    def name():
+        return "CoppeliaMultiCameraModule"
+
+    @staticmethod
+    def description():
+        return "A camera module for CoppeliaSim that produces synchronized images of several sensors"
+
+    def output_iu(self):
+        return MultiImageIU if self.combined else super().output_iu()
+
+    def __init__(self, scene, start_scene=False, sensor_paths=None, combined=False, **kwargs):
+        """
+        :param sensor_paths: The paths of the vision sensors within the scene.
+        :param combined: Whether to emit one MultiImageIU per capture instead of one ImageIU per sensor.
+
+        All other arguments are those of CoppeliaCameraModule.
+        """
+        if not sensor_paths:
+            raise Exception("No CoppeliaSim sensor paths specified.")
+
+        self.combined = combined
+        self.sensor_paths = list(sensor_paths)
+        super().__init__(scene, start_scene, sensor_path=sensor_paths[0], **kwargs)
+
+        self.frame_set = 0
+        self._handles = None
+        self._sensor_frames = {path: FrameBuffers(self._frames.count) for path in self.sensor_paths}
+        self._script = define_script_functions(self.sim, _GET_VISION_SENSOR_IMGS_LUA)
+
+    def _metrics_sensor(self):
+        return ",".join(self.sensor_paths)
+
+    def _on_scene_loaded(self, scene):
+        super()._on_scene_loaded(scene)
+        self._handles = None
+
+    def capture(self):
+        """Grabs the current images of all vision sensors and appends them to the output.
+
+        :return: True if a set of frames was produced, False if it was skipped or a visualizer window was closed.
+        """
+        if self._handles is None:
+            self._handles = [self.sim.getObject(path) for path in self.sensor_paths]
+            read_args = [self._sensor_read_args(handle) for handle in self._handles]
+            self._options = 1 if self.grayscale else 0
+            self._positions = [args[2] if len(args) > 2 else [0, 0] for args in read_args]
+            self._sizes = [args[3] if len(args) > 3 else [0, 0] for args in read_args]
+
+        if self.require_sim_advance and self.sim.getSimulationTime() == self._last_sim_time:
+            self.frames_skipped += 1
+            return False
+
+        start = time.perf_counter()
+        img_buffers, resolutions, sim_time = self.sim.callScriptFunction(
+            "retico_getVisionSensorImgs",
+            self._script,
+            self._handles,
+            self._options,
+            self._positions,
+            self._sizes
+        )
+        self._rpc_time.observe(time.perf_counter() - start)
+        if self.skip_duplicates:
+            digest = tuple(zlib.crc32(img_buffer) for img_buffer in img_buffers)
+            if digest == self._last_digest:
+                self.frames_skipped += 1
+                return False
+            self._last_digest = digest
+        self._last_sim_time = sim_time
+
+        converting = time.perf_counter()
+        images = {}
+        for path, img_buffer, res in zip(self.sensor_paths, img_buffers, resolutions):
+            img = self._process_frame(img_buffer, res, self._sensor_frames[path])
+
+            if self.visualizer:
+                cv2.imshow(path, img)
+            images[path] = self._to_payload(img)
+        self._convert_time.observe(time.perf_counter() - converting)
+
+        if self.visualizer:
+            k = cv2.waitKey(1) & 0xFF
+            if k == 27:
+                cv2.destroyAllWindows()
+                self._vision_loop_active = False
+                return False
+
+        rate = self.fps if self.fps is not None else -1
+        update_message = retico_core.UpdateMessage()
+        if self.combined:
+            output_iu = self.create_iu()
+            output_iu.set_images(images, len(images), rate)
+            output_iu.meta_data.update(sim_time=sim_time, frame_set=self.frame_set)
+            output_iu.encoding = self.encoding
+            update_message.add_iu(output_iu, retico_core.UpdateType.ADD)
+        else:
+            for path, frame in images.items():
+                output_iu = self.create_iu()
+                output_iu.set_image(frame, 1, rate)
+                output_iu.meta_data.update(sensor_path=path, sim_time=sim_time, frame_set=self.frame_set)
+                if self.encoding is not None:
+                    output_iu.encoding = self.encoding
+                update_message.add_iu(output_iu, retico_core.UpdateType.ADD)
+
+        self.append(update_message)
+        self._emit_latency.observe(time.perf_counter() - start)
+        self.frame_set += 1
+        self.frames_emitted += 1
+        return True
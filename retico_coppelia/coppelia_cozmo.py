@@ -1,31 +1,249 @@
+import itertools
+import queue
+import threading
 import time
+import weakref
+from collections import deque
+from concurrent.futures import Future, wait
 import retico_core
-from coppeliasim_zmqremoteapi_client import RemoteAPIClient
+from retico_coppelia.coppelia_metrics import metrics
+from retico_coppelia.coppelia_session import CoppeliaSession
 from retico_coppelia.coppelia_cozmo_util import *
 
+# The actuator each command moves. Commands on different actuators can run at the same time.
+ACTUATORS = {'turn': 'wheels', 'drive': 'wheels', 'look': 'head', 'lift': 'lift'}
+
+# Runs whole command sequences inside the Cozmo robot's script. Each command is a {function, arg, arg, wait} table, and a
+# command with wait set holds back the rest of its sequence until is_moving() turns false. Sequences queue up behind
+# each other and are advanced after the script's own actuation callback on every simulation step.
+_SEQUENCE_LUA = '''
+retico_sequences = retico_sequences or {}
+-- Sequences whose last commands don't block, by id, with the simulation time they were issued at. They stay pending
+-- until the robot is seen stopped at a later time, as their motion only registers after the next actuation
+retico_settling = retico_settling or {}
+
+function retico_advance_sequences()
+    local now = sim.getSimulationTime()
+    if next(retico_settling) ~= nil and not is_moving() then
+        for id, issued_at in pairs(retico_settling) do
+            if issued_at < now then retico_settling[id] = nil end
+        end
+    end
+    local sequence = retico_sequences[1]
+    while sequence do
+        if sequence.waiting then
+            if is_moving() then return end
+            sequence.waiting = false
+            sequence.issued = false
+        end
+        local command = sequence.commands[sequence.index]
+        if command == nil then
+            table.remove(retico_sequences, 1)
+            if sequence.issued then retico_settling[sequence.id] = now end
+            sequence = retico_sequences[1]
+        else
+            _G[command[1]](command[2], command[3])
+            sequence.index = sequence.index + 1
+            sequence.issued = true
+            if command[4] then
+                -- The motion only registers as moving after the next actuation, so check back then
+                sequence.waiting = true
+                return
+            end
+        end
+    end
+end
+
+function retico_run_sequence(id, commands)
+    table.insert(retico_sequences, {id = id, commands = commands, index = 1, waiting = false, issued = false})
+    retico_advance_sequences()
+    return retico_sequence_pending(id)
+end
+
+function retico_pending_sequences()
+    local ids = {}
+    for i = 1, #retico_sequences do
+        ids[i] = retico_sequences[i].id
+    end
+    for id in pairs(retico_settling) do
+        ids[#ids + 1] = id
+    end
+    return ids
+end
+
+function retico_sequence_pending(id)
+    if retico_settling[id] ~= nil then return true end
+    for i = 1, #retico_sequences do
+        if retico_sequences[i].id == id then return true end
+    end
+    return false
+end
+
+-- Returns 'started' if the robot may still be moving because of the sequence, 'queued' if none of its commands had
+-- been issued, or nil if it wasn't pending
+function retico_cancel_sequence(id)
+    local status = nil
+    if retico_settling[id] ~= nil then
+        retico_settling[id] = nil
+        status = 'started'
+    end
+    for i = #retico_sequences, 1, -1 do
+        local sequence = retico_sequences[i]
+        if sequence.id == id then
+            table.remove(retico_sequences, i)
+            if sequence.index > 1 then status = 'started' else status = status or 'queued' end
+        end
+    end
+    return status
+end
+
+if not retico_actuation_installed then
+    retico_actuation_installed = true
+    local actuation = sysCall_actuation
+    function sysCall_actuation()
+        if actuation then actuation() end
+        retico_advance_sequences()
+    end
+    -- If the script publishes its state while sensing, advance first, so that a published stop already reflects
+    -- the sequences that stop completed
+    local sensing = sysCall_sensing
+    if sensing then
+        function sysCall_sensing()
+            retico_advance_sequences()
+            return sensing()
+        end
+    end
+end
+'''
+
+
+class CozmoAction(Future):
+    """A Future for a command sent to a Cozmo robot. It resolves to True once the robot has stopped moving after the
+    command, as observed by wait_until_completed() or by the robot's state feed (see Cozmo.notify_state()).
+
+    Since the simulated robot only reports whether it is moving as a whole, an action is considered complete when all
+    of the robot's motions have stopped.
+    """
+
+    def __init__(self, robot, command):
+        super().__init__()
+        self.robot = robot
+        self.command = command
+        self.set_running_or_notify_cancel()
+
+    def wait_until_completed(self):
+        """Blocks until the robot has stopped moving.
+
+        :return: A reference to self.
+        """
+        if not self.done():
+            self.robot.wait_until_completed()
+        return self
+
+
+class CozmoSequence(Future):
+    """A Future for a sequence of commands that runs inside the Cozmo robot's script (see Cozmo.run_sequence()). It
+    resolves to True once the script has worked through the whole sequence and the robot has stopped after its last
+    commands, or to False if it was aborted first.
+
+    With a state feed (see Cozmo.notify_state()), pending sequences are checked once each time the robot is seen
+    stopping, so nothing polls the script while they run.
+    """
+
+    def __init__(self, robot, sequence_id):
+        super().__init__()
+        self.robot = robot
+        self.sequence_id = sequence_id
+        self.set_running_or_notify_cancel()
+
+    def wait_until_completed(self):
+        """Blocks until the sequence has run. Without a state feed, the script is asked every poll_interval of the
+        robot; with one, only as a fallback if no state resolved the sequence within poll_interval.
+
+        :return: A reference to self.
+        """
+        interval = self.robot.poll_interval
+        while not self.done():
+            if self.robot._state_fed:
+                wait([self], timeout=interval)
+                if self.done(): break
+            # Resolves every sequence the script has finished, not just this one
+            self.robot._complete_sequences()
+            if self.done(): break
+            if not self.robot._state_fed:
+                time.sleep(interval)
+        return self
+
+    def abort(self):
+        """Drops the commands of the sequence that haven't been issued yet.
+
+        :return: See Cozmo.cancel_sequence().
+        """
+        status = self.robot.cancel_sequence(self.sequence_id)
+        self.robot._finish_sequence(self.sequence_id, False)
+        return status
+
+
 class Cozmo:
     """An object for interfacing with a Cozmo robot within CoppeliaSim."""
 
-    def __init__(self, cozmo_path, scene, start_scene=False):
+    def __init__(self, cozmo_path, scene, start_scene=False, session=None, poll_interval=0.1, moving_key='is_moving',
+                 host='localhost', port=23000):
+        """
+        :param cozmo_path: The path of the Cozmo robot within the scene.
+        :param scene: The scene file to load if start_scene is True.
+        :param start_scene: Whether to load the scene (unless it is loaded already) and start (and on shutdown stop)
+        the simulation. See SceneManager.
+        :param session: The CoppeliaSession to talk to the simulator through. By default, the session shared for
+        host and port (see CoppeliaSession.shared()), so that modules share its scene manager.
+        :param poll_interval: How often wait_until_completed() asks the simulator whether Cozmo is still moving when
+        no state feed is available, and how often it double-checks when one is.
+        :param moving_key: The key of the published state that tells whether Cozmo is moving. See notify_state().
+        :param host: The host of the CoppeliaSim instance to connect to if no session is given.
+        :param port: The port of that instance's ZMQ remote API server.
+        """
+        self.cozmo_path = cozmo_path
         self.start_scene = start_scene
-        self._sim = RemoteAPIClient().require('sim')
+        self.poll_interval = poll_interval
+        self.moving_key = moving_key
+        self._state_fed = False
+        self._seen_moving = False
+        self._stopped = threading.Event()
+        # Actions nobody holds on to anymore don't need to be resolved, so they are only referenced weakly
+        self._actions = weakref.WeakSet()
+        self._actions_lock = threading.Lock()
+        self._sequence_ids = itertools.count(1)
+        self._sequences = weakref.WeakValueDictionary()  # The CozmoSequences the script may still be running
+        self._sequences_installed = False
+        labels = {'robot': cozmo_path, 'instance': metrics.instance(self)}
+        self._wait_time = metrics.histogram('cozmo_wait_seconds', "Time spent in wait_until_completed()", owner=self,
+                                            **labels)
+        self._polls = metrics.counter('cozmo_is_moving_polls', "Calls to the script's is_moving()", owner=self,
+                                      **labels)
+        self.session = session if session is not None else CoppeliaSession.shared(host, port)
+        self._sim = self.session.sim
 
         if self.start_scene:
-            self._sim.loadScene(scene)
+            self.session.scenes.load(scene)
+        self._init_script()
+        self.session.scenes.add_listener(self._on_scene_loaded)
 
-        # Initialize scene script
-        self._script_handle = self._sim.getScript(self._sim.scripttype_simulation, cozmo_path + '/Script')
+        if self.start_scene:
+            self.session.scenes.start()
+
+    def _init_script(self):
+        self._script_handle = self._sim.getScript(self._sim.scripttype_simulation, self.cozmo_path + '/Script')
         self._sim.initScript(self._script_handle)
+        self._sequences_installed = False
 
-        if self.start_scene:
-            print("Starting simulation...")
-            self._sim.startSimulation()
+    def _on_scene_loaded(self, scene):
+        # The robot's script belongs to the previous scene
+        self._init_script()
 
     def shutdown(self):
-        """Stops the simulation if self was used to start the simulation."""
+        """Stops the simulation if self was used to start the simulation and no other module still needs it."""
         if self.start_scene:
-            print("Stopping simulation...")
-            self._sim.stopSimulation()
+            self.session.scenes.stop()
 
     def set_zmq_port(self, port):
         """Sets the port for Cozmo to use for ZMQ messaging.
@@ -38,12 +256,170 @@ class Cozmo:
             port
         )
 
+    def is_moving(self):
+        """Calls the Cozmo robot script function is_moving() within CoppeliaSim.
+
+        :return: Whether the robot is currently moving.
+        """
+        self._polls.inc()
+        moving = self._sim.callScriptFunction("is_moving", self._script_handle)
+        if not moving:
+            self._complete_actions()
+        return moving
+
+    def notify_state(self, state):
+        """Feeds a state published by the robot's script (see CozmoStateModule) to the motion tracking. Once states
+        carrying the moving_key arrive, wait_until_completed() returns as soon as a state reports that a motion has
+        stopped, instead of polling is_moving().
+
+        :param state: The published state, as a dict.
+        """
+        if self.moving_key not in state: return
+
+        self._state_fed = True
+        if state[self.moving_key]:
+            self._seen_moving = True
+        elif self._seen_moving:
+            self._seen_moving = False
+            self._stopped.set()
+            self._complete_actions()
+            if len(self._sequences) > 0:
+                self._complete_sequences()
+
     def wait_until_completed(self):
         """Hangs execution of function calls from a Cozmo object until the corresponding CoppeliaSim robot has stopped
         moving.
         """
-        while self._sim.callScriptFunction("is_moving", self._script_handle):
-            time.sleep(0.1)
+        start = time.perf_counter()
+        if not self._state_fed:
+            while self.is_moving():
+                time.sleep(self.poll_interval)
+        else:
+            # A motion that ends before any state reports it as moving never sets _stopped, so keep checking
+            # is_moving() at the polling interval as a fallback
+            while not self._stopped.wait(self.poll_interval):
+                if not self.is_moving():
+                    break
+        self._complete_actions()
+        self._wait_time.observe(time.perf_counter() - start)
+
+    def stop(self):
+        """Calls the Cozmo robot script function stop() within CoppeliaSim, which halts all of Cozmo's motions.
+
+        :return: Whether the call succeeded. The scene's Cozmo script has to define stop() for this to work.
+        """
+        try:
+            self._sim.callScriptFunction("stop", self._script_handle)
+        except Exception as e:
+            print(f"Could not stop Cozmo: {e}")
+            return False
+        return True
+
+    def execute(self, command, value):
+        """Runs a single command of a CoppeliaCozmoIU payload.
+
+        :param command: One of 'turn', 'look', 'lift' or 'drive'.
+        :param value: The [angle | distance | position, speed, wait_status] list of the command. wait_status is ignored
+        here; call wait_until_completed() on the result to block.
+        :return: A CozmoAction for the command.
+        """
+        if "turn" == command:
+            return self.turn_in_place(angle=value[0], speed=value[1])
+        elif "look" == command:
+            return self.set_head_angle(height=value[0], speed=value[1])
+        elif "lift" == command:
+            return self.set_lift_height(height=value[0], speed=value[1])
+        elif "drive" == command:
+            return self.drive_straight(distance=value[0], speed=value[1])
+        raise Exception(f"Invalid command {command}.")
+
+    def run_sequence(self, payload, sequence_id=None):
+        """Sends all commands of a CoppeliaCozmoIU payload to the robot's script in a single call. The script runs them in
+        payload order, holding back the rest of the sequence after each command whose wait_status is True until Cozmo
+        has stopped moving, so there are no remote calls while the sequence runs.
+
+        :param payload: A CoppeliaCozmoIU payload.
+        :param sequence_id: An optional id for the sequence, for cancel_sequence(). It has to be unique among the
+        robot's pending sequences; by default, a new id is generated.
+        :return: A CozmoSequence that resolves once the script has worked through the sequence and Cozmo has stopped
+        after it.
+        """
+        if not self._sequences_installed:
+            self._sim.executeScriptString(_SEQUENCE_LUA, self._script_handle)
+            self._sequences_installed = True
+
+        if sequence_id is None:
+            sequence_id = str(next(self._sequence_ids))
+
+        commands = []
+        for command, value in payload.items():
+            function, args = self._script_call(command, value)
+            commands.append([function, *args, bool(value[2])])
+
+        self._seen_moving = False
+        self._stopped.clear()
+        sequence = CozmoSequence(self, sequence_id)
+        with self._actions_lock:
+            self._sequences[sequence_id] = sequence
+        if not self._sim.callScriptFunction("retico_run_sequence", self._script_handle, sequence_id, commands):
+            self._finish_sequence(sequence_id, True)
+        return sequence
+
+    def sequence_pending(self, sequence_id):
+        """Returns whether the script still has commands of the given sequence to run, or hasn't seen Cozmo stop since
+        issuing its last ones."""
+        return self._sim.callScriptFunction("retico_sequence_pending", self._script_handle, sequence_id)
+
+    def cancel_sequence(self, sequence_id):
+        """Drops the commands of the given sequence that the script hasn't issued yet. This doesn't stop the commands
+        that have been issued; call stop() for that if the sequence had started.
+
+        :return: 'started' if some of the sequence's commands had been issued and Cozmo may still be carrying them
+        out, 'queued' if none had been issued, e.g. because the sequence was waiting for another one, or None if the
+        sequence wasn't pending.
+        """
+        return self._sim.callScriptFunction("retico_cancel_sequence", self._script_handle, sequence_id)
+
+    def _complete_sequences(self):
+        """Resolves the sequences the script has worked through, with a single remote call."""
+        pending = set(self._sim.callScriptFunction("retico_pending_sequences", self._script_handle))
+        for sequence_id in list(self._sequences.keys()):
+            if sequence_id not in pending:
+                self._finish_sequence(sequence_id, True)
+
+    def _finish_sequence(self, sequence_id, result):
+        with self._actions_lock:
+            sequence = self._sequences.pop(sequence_id, None)
+        if sequence is not None:
+            sequence.set_result(result)
+
+    @staticmethod
+    def _script_call(command, value):
+        """Returns the script function and its arguments for a single command of a CoppeliaCozmoIU payload."""
+        if "turn" == command:
+            return "turn_in_place", [value[0].to_radians(), value[1].to_rads()]
+        elif "look" == command:
+            return "set_head_angle", [value[0], value[1].to_rads()]
+        elif "lift" == command:
+            return "set_lift_height", [value[0], value[1].to_rads()]
+        elif "drive" == command:
+            return "drive_straight", [value[0].to_mm(), value[1].to_mmps()]
+        raise Exception(f"Invalid command {command}.")
+
+    def _start_motion(self, command):
+        self._seen_moving = False
+        self._stopped.clear()
+        action = CozmoAction(self, command)
+        with self._actions_lock:
+            self._actions.add(action)
+        return action
+
+    def _complete_actions(self):
+        with self._actions_lock:
+            actions = list(self._actions)
+            self._actions.clear()
+        for action in actions:
+            action.set_result(True)
 
     def turn_in_place(self, angle: Angle, speed: AngularSpeed):
         """Calls the Cozmo robot script function turn_in_place() within CoppeliaSim.
@@ -51,10 +427,11 @@ class Cozmo:
         :param angle: An Angle object denoting how far to turn. The Angle is relative to the position of Cozmo at call
         time.
         :param speed: The speed at which Cozmo should turn.
-        :return: A reference to self, allowing wait_until_completed() to be called to prevent parallel actions.
+        :return: A CozmoAction, allowing wait_until_completed() to be called to prevent parallel actions.
         """
+        action = self._start_motion("turn_in_place")
         self._sim.callScriptFunction("turn_in_place", self._script_handle, angle.to_radians(), speed.to_rads())
-        return self
+        return action
 
     def set_head_angle(self, height: float, speed: AngularSpeed):
         """Calls the Cozmo robot script function set_head_angle() within CoppeliaSim.
@@ -62,10 +439,11 @@ class Cozmo:
         :param height: The position or angle that Cozmo's head should be set to. Can be a float from 0 to 1, and
         represents a percentage of Cozmo's full head range.
         :param speed: An AngularSpeed object, denoting how fast Cozmo should change its head position.
-        :return: A reference to self, allowing wait_until_completed() to be called to prevent parallel actions.
+        :return: A CozmoAction, allowing wait_until_completed() to be called to prevent parallel actions.
         """
+        action = self._start_motion("set_head_angle")
         self._sim.callScriptFunction("set_head_angle", self._script_handle, height, speed.to_rads())
-        return self
+        return action
 
     def set_lift_height(self, height: float, speed: AngularSpeed):
         """Calls the Cozmo robot script function set_lift_height() within CoppeliaSim.
@@ -73,22 +451,204 @@ class Cozmo:
         :param height: The position that Cozmo's lift should be set to. Can be a float from 0 to 1, and represents a
         percentage of Cozmo's full lift range.
         :param speed: An AngularSpeed object, denoting how fast Cozmo should change its lift position.
-        :return: A reference to self, allowing wait_until_completed() to be called to prevent parallel actions.
+        :return: A CozmoAction, allowing wait_until_completed() to be called to prevent parallel actions.
         """
+        action = self._start_motion("set_lift_height")
         self._sim.callScriptFunction("set_lift_height", self._script_handle, height, speed.to_rads())
-        return self
+        return action
 
     def drive_straight(self, distance: Distance, speed: MMPS):
         """Calls the Cozmo robot script function drive_straight() within CoppeliaSim.
 
         :param distance: A Distance object, denoting how far Cozmo should travel in a straight line.
         :param speed: An MMPS object, denoting how fast Cozmo should travel.
-        :return: A reference to self, allowing wait_until_completed() to be called to prevent parallel actions.
+        :return: A CozmoAction, allowing wait_until_completed() to be called to prevent parallel actions.
         """
+        action = self._start_motion("drive_straight")
         self._sim.callScriptFunction("drive_straight", self._script_handle, distance.to_mm(), speed.to_mmps())
-        return self
+        return action
     
 
+class CozmoActionScheduler:
+    """Runs the commands of CoppeliaCozmoIUs on background threads, so that the caller never blocks on a motion.
+
+    Commands are queued on lanes that each run their commands in order, blocking on a command whose wait_status is True
+    before starting the next command of the same lane. By default there is a single lane, which keeps the ordering of
+    running the commands inline. With per_actuator=True there is one lane per actuator (wheels, head and lift), so that
+    e.g. a look command doesn't wait for a blocking turn to finish, while a drive command still does.
+
+    Commands can be tagged with the IU they came from, so that revoke() can cancel all of an IU's queued commands and
+    stop its running ones, unless the IU has been committed. A command counts as running from the moment it is issued
+    until its action resolves, i.e. until the robot is next seen stopped, even if its lane has moved on because the
+    command doesn't block.
+    """
+
+    def __init__(self, robot, per_actuator=False):
+        """
+        :param robot: The Cozmo robot to run the commands on.
+        :param per_actuator: Whether to run the commands of different actuators independently of each other.
+        """
+        self.robot = robot
+        self.per_actuator = per_actuator
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._tagged = {}
+        self._running = {}
+        self._in_flight = {}  # Tag -> the issued actions of the tag that haven't resolved yet
+        self._committed = set()
+        self._aborting = set()  # Tags revoked while their sequence was being handed to the script
+        labels = {'robot': robot.cozmo_path, 'instance': metrics.instance(self)}
+        self._queue_time = metrics.histogram('cozmo_action_queue_seconds',
+                                             "Time commands wait in the scheduler before they start", owner=self,
+                                             **labels)
+        self._run_time = metrics.histogram('cozmo_action_seconds', "Time from a command starting to it completing",
+                                           owner=self, **labels)
+        metrics.gauge('cozmo_actions_queued', "Commands waiting in the scheduler",
+                      fn=lambda s: sum(lane.qsize() for lane in list(s._lanes.values())), owner=self, **labels)
+
+    def submit(self, command, value, tag=None):
+        """Queues a command.
+
+        :param command: One of 'turn', 'look', 'lift' or 'drive'.
+        :param value: The [angle | distance | position, speed, wait_status] list of the command.
+        :param tag: An optional hashable tag, usually the IUTag of the IU the command came from, for revoke() and
+        commit().
+        :return: A Future that resolves to the command's CozmoAction once the command has been issued and, if its
+        wait_status is True, completed.
+        """
+        lane = ACTUATORS[command] if self.per_actuator else 'robot'
+        return self._submit(lane, lambda: self.robot.execute(command, value), value[2], tag)
+
+    def submit_sequence(self, payload, tag=None):
+        """Queues all commands of a CoppeliaCozmoIU payload to run as one sequence inside the robot's script. See
+        Cozmo.run_sequence(). The script runs sequences one after the other, so the lane doesn't wait for a sequence to
+        finish before handing over the next one.
+
+        :param payload: A CoppeliaCozmoIU payload.
+        :param tag: An optional hashable tag, usually the IUTag of the IU the payload came from, for revoke() and
+        commit().
+        :return: A Future that resolves to the CozmoSequence once it has been handed to the script. The CozmoSequence
+        itself resolves once the script has worked through it.
+        """
+        return self._submit('sequence', lambda: self.robot.run_sequence(payload), False, tag)
+
+    def _submit(self, lane, start, wait, tag):
+        future = Future()
+        if tag is not None:
+            with self._lock:
+                self._tagged.setdefault(tag, []).append(future)
+            future.add_done_callback(lambda f: self._untag(tag, f))
+        self._lane(lane).put((future, start, wait, tag, time.perf_counter()))
+        return future
+
+    def revoke(self, tag):
+        """Cancels the queued commands with the given tag and stops the robot if one of them is running. Commands of
+        committed tags are final and are not revoked.
+
+        :return: The number of commands that were cancelled or stopped.
+        """
+        with self._lock:
+            if tag in self._committed: return 0
+            futures = list(self._tagged.get(tag, []))
+            sequence_lane = self._lanes.get('sequence')
+            running = []
+            for lane, (running_tag, action) in self._running.items():
+                if running_tag != tag: continue
+                if action is None and lane is sequence_lane:
+                    # The sequence has no id yet, so the lane aborts it once it has been handed over
+                    self._aborting.add(tag)
+                else:
+                    running.append(action)
+            in_flight = [action for action in self._in_flight.pop(tag, ()) if not action.done()]
+
+        revoked = sum(future.cancel() for future in futures)
+        sequences = [action for action in running + in_flight if isinstance(action, CozmoSequence)]
+        running = [action for action in running if not isinstance(action, CozmoSequence)]
+        in_flight = [action for action in in_flight if not isinstance(action, CozmoSequence)]
+        # Only stop the robot for a sequence the script had started on, as a queued one leaves the motions of the
+        # sequences ahead of it alone
+        started = [sequence.abort() == 'started' for sequence in sequences]
+        # A command that is still being issued counts as moving; otherwise ask the robot, which also resolves the
+        # actions if it has stopped in the meantime
+        if any(started) or len(running) > 0 or (len(in_flight) > 0 and self.robot.is_moving()):
+            if self.robot.stop():
+                revoked += 1
+        return revoked
+
+    def commit(self, tag):
+        """Marks the commands with the given tag as final, so that they can no longer be revoked."""
+        with self._lock:
+            if tag in self._tagged:
+                self._committed.add(tag)
+            self._in_flight.pop(tag, None)
+
+    def _untag(self, tag, future):
+        with self._lock:
+            futures = self._tagged.get(tag)
+            if futures is None: return
+            futures.remove(future)
+            if len(futures) == 0:
+                del self._tagged[tag]
+                self._committed.discard(tag)
+
+    def _landed(self, tag, action):
+        with self._lock:
+            actions = self._in_flight.get(tag)
+            if actions is None: return
+            actions.discard(action)
+            if len(actions) == 0:
+                del self._in_flight[tag]
+
+    def shutdown(self):
+        """Stops the lanes once their queued commands have run."""
+        with self._lock:
+            for lane in self._lanes.values():
+                lane.put(None)
+            self._lanes = {}
+
+    def _lane(self, name):
+        with self._lock:
+            lane = self._lanes.get(name)
+            if lane is None:
+                lane = queue.Queue()
+                self._lanes[name] = lane
+                threading.Thread(target=self._run_lane, args=[lane], daemon=True).start()
+        return lane
+
+    def _run_lane(self, lane):
+        while True:
+            item = lane.get()
+            if item is None: return
+
+            future, start, wait, tag, queued_at = item
+            if not future.set_running_or_notify_cancel(): continue
+            started_at = time.perf_counter()
+            self._queue_time.observe(started_at - queued_at)
+            with self._lock:
+                self._running[lane] = (tag, None)
+            try:
+                action = start()
+                with self._lock:
+                    self._running[lane] = (tag, action)
+                    aborting = tag in self._aborting
+                    self._aborting.discard(tag)
+                    if tag is not None and tag not in self._committed and not aborting:
+                        self._in_flight.setdefault(tag, set()).add(action)
+                if aborting and action.abort() == 'started':
+                    self.robot.stop()
+                action.add_done_callback(lambda a: self._landed(tag, a))
+                if wait:
+                    action.wait_until_completed()
+                self._run_time.observe(time.perf_counter() - started_at)
+                future.set_result(action)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._running.pop(lane, None)
+                    self._aborting.discard(tag)
+
+
 class CoppeliaCozmoIU(retico_core.abstract.IncrementalUnit):
     """Incremental Unit for sending information to a CoppeliaCozmoModule.
 
@@ -174,6 +734,23 @@ class CoppeliaCozmoIU(retico_core.abstract.IncrementalUnit):
         self.payload['drive'] = [distance, speed, wait_status]
 
 
+class IUTag:
+    """Tags the commands of an IU for CozmoActionScheduler by the IU's identity. IUs compare by their iuid, which
+    defaults to 0, so IUs that were created without one would otherwise share a tag. The tag keeps its IU alive, so
+    that its identity can't be reused while the tag is in use."""
+
+    __slots__ = ['iu']
+
+    def __init__(self, iu):
+        self.iu = iu
+
+    def __eq__(self, other):
+        return isinstance(other, IUTag) and other.iu is self.iu
+
+    def __hash__(self):
+        return id(self.iu)
+
+
 class CoppeliaCozmoModule(retico_core.AbstractConsumingModule):
     """A Retico module for controlling a Cozmo robot inside a CoppeliaSim scene."""
 
@@ -193,42 +770,116 @@ class CoppeliaCozmoModule(retico_core.AbstractConsumingModule):
     def output_iu():
         return None
 
-    def __init__(self, cozmo_path, scene, start_scene=False, **kwargs):
+    def __init__(self, cozmo_path, scene, start_scene=False, stepped=False, session=None, per_actuator=False,
+                 batch=False, host='localhost', port=23000, **kwargs):
+        """
+        :param cozmo_path: The path of the Cozmo robot within the scene.
+        :param scene: The scene file to load if start_scene is True.
+        :param start_scene: Whether this module should load and start (and on shutdown stop) the simulation.
+        :param stepped: If True, commands are only issued when flush() is called, e.g. by a CoppeliaStepScheduler
+        before each simulation step, and blocking commands hold back the following ones until Cozmo has stopped
+        moving instead of blocking the calling thread.
+        :param session: The CoppeliaSession to talk to the simulator through. By default, the session shared
+        for host and port (see CoppeliaSession.shared()).
+        :param per_actuator: Whether blocking commands only hold back later commands on the same actuator, rather than
+        all later commands. See CozmoActionScheduler.
+        :param batch: If True, each IU's payload is sent to the robot's script in a single call and run there as a
+        sequence, instead of one remote call per command plus polling for completion. See Cozmo.run_sequence().
+        :param host: The host of the CoppeliaSim instance to connect to if no session is given.
+        :param port: The port of that instance's ZMQ remote API server.
+        """
         super().__init__(**kwargs)
-        self.robot = Cozmo(cozmo_path, scene, start_scene)
+        self.robot = Cozmo(cozmo_path, scene, start_scene, session, host=host, port=port)
+        self.scheduler = CozmoActionScheduler(self.robot, per_actuator)
+        self.stepped = stepped
+        self.batch = batch
         self.queue = []
+        self._commands = deque()
+        self._waiting = None
+        self._sequences = {}  # IUTag -> the CozmoSequence of a stepped batch IU that hasn't resolved yet
+        self._lock = threading.Lock()
 
     def process_update(self, update_message):
         for iu, ut in update_message:
             if ut == retico_core.abstract.UpdateType.ADD:
-                self.queue.append(iu)
-        self.process_iu()
+                with self._lock:
+                    self.queue.append(iu)
+            elif ut == retico_core.abstract.UpdateType.REVOKE:
+                self.revoke(iu)
+            elif ut == retico_core.abstract.UpdateType.COMMIT:
+                self.scheduler.commit(IUTag(iu))
+                with self._lock:
+                    self._sequences.pop(IUTag(iu), None)
+
+        if not self.stepped:
+            self.process_iu()
+
+    def revoke(self, iu):
+        """Drops the commands of iu that haven't been issued yet and stops Cozmo if one of them is being executed."""
+        with self._lock:
+            if iu in self.queue:
+                self.queue.remove(iu)
+                return
+
+            if self.stepped and self.batch:
+                sequence = self._sequences.pop(IUTag(iu), None)
+                # A sequence queued behind another one leaves the other's motions alone
+                if sequence is not None and sequence.abort() == 'started':
+                    self.robot.stop()
+                return
+            elif self.stepped:
+                tag = IUTag(iu)
+                self._commands = deque(command for command in self._commands if command[0] != tag)
+                if self._waiting == tag and self.robot.stop():
+                    self._waiting = None
+                return
+
+        self.scheduler.revoke(IUTag(iu))
 
     def process_iu(self):
-        if len(self.queue) == 0: return
+        """Hands the commands of all queued IUs to the action scheduler, which runs them in the background.
 
-        iu = self.queue.pop(0)
-        for key, value in iu.payload.items():
-            if "turn" == key:
-                if value[2]:
-                    self.robot.turn_in_place(angle=value[0], speed=value[1]).wait_until_completed()
-                else:
-                    self.robot.turn_in_place(angle=value[0], speed=value[1])
-            elif "look" == key:
-                if value[2]:
-                    self.robot.set_head_angle(height=value[0], speed=value[1]).wait_until_completed()
-                else:
-                    self.robot.set_head_angle(height=value[0], speed=value[1])
-            elif "lift" == key:
-                if value[2]:
-                    self.robot.set_lift_height(height=value[0], speed=value[1]).wait_until_completed()
-                else:
-                    self.robot.set_lift_height(height=value[0], speed=value[1])
-            elif "drive" == key:
+        :return: A list with a Future per command. See CozmoActionScheduler.submit().
+        """
+        futures = []
+        with self._lock:
+            ius, self.queue = self.queue, []
+        for iu in ius:
+            if self.batch:
+                futures.append(self.scheduler.submit_sequence(iu.payload, IUTag(iu)))
+                continue
+            tag = IUTag(iu)
+            for key, value in iu.payload.items():
+                futures.append(self.scheduler.submit(key, value, tag))
+        return futures
+
+    def flush(self):
+        """Issues queued commands without blocking. Issuing stops at the first blocking command, and continues on a
+        later call once Cozmo has stopped moving. In batch mode, each IU is handed to the robot's script as a sequence,
+        which the script advances with the simulation."""
+        with self._lock:
+            if self.batch:
+                self._sequences = {tag: sequence for tag, sequence in self._sequences.items() if not sequence.done()}
+                for iu in self.queue:
+                    self._sequences[IUTag(iu)] = self.robot.run_sequence(iu.payload)
+                self.queue = []
+                return
+
+            if self._waiting is not None:
+                if self.robot.is_moving(): return
+                self._waiting = None
+
+            for iu in self.queue:
+                self._commands.extend((IUTag(iu), key, value) for key, value in iu.payload.items())
+            self.queue = []
+
+            while len(self._commands) > 0:
+                tag, key, value = self._commands.popleft()
+                self.robot.execute(key, value)
                 if value[2]:
-                    self.robot.drive_straight(distance=value[0], speed=value[1]).wait_until_completed()
-                else:
-                    self.robot.drive_straight(distance=value[0], speed=value[1])
+                    self._waiting = tag
+                    return
 
     def shutdown(self):
+        self.scheduler.shutdown()
         self.robot.shutdown()
@@ -1,12 +1,236 @@
+import json
+import math
+import struct
 import threading
+import time
 import zmq
+from array import array
 from collections import deque
+from collections.abc import Mapping
 from retico_core.abstract import AbstractProducingModule, UpdateMessage, UpdateType, IncrementalUnit
-from coppeliasim_zmqremoteapi_client import RemoteAPIClient
 from retico_coppelia.coppelia_cozmo import Cozmo
+from retico_coppelia.coppelia_metrics import metrics
 # from retico_coppelia.coppelia_cozmo_util import CozmoStateIU
 
 
+class StateSchema:
+    """Describes the fixed binary layout of the states a Cozmo robot's script publishes, so that they can be decoded
+    with a single struct.unpack() instead of parsing JSON.
+
+    The script has to pack the fields in the same order, e.g. with Lua's string.pack('<ddd?', ...) for the default
+    little-endian layout of doubles.
+
+    Example:\n
+    schema = StateSchema(['x', 'y', 'theta', 'head_angle', 'lift_height', 'is_moving'], '<ddddd?')
+    """
+
+    def __init__(self, fields, fmt=None):
+        """
+        :param fields: The names of the fields, in the order they are packed.
+        :param fmt: The struct format of a packed state. Defaults to one little-endian double per field.
+        """
+        self.fields = tuple(fields)
+        self.struct = struct.Struct(fmt if fmt is not None else '<' + 'd' * len(self.fields))
+        self.index = {field: i for i, field in enumerate(self.fields)}
+
+        if len(self.struct.unpack(bytes(self.struct.size))) != len(self.fields):
+            raise Exception(f"The format {self.struct.format} does not describe {len(self.fields)} fields.")
+
+    def unpack(self, data):
+        """Decodes a packed state.
+
+        :param data: The bytes published by the script.
+        :return: A StateRecord.
+        """
+        return StateRecord(self, self.struct.unpack(data))
+
+    def record(self, values):
+        """Wraps a sequence of values in schema order (e.g. a decoded msgpack array) in a StateRecord."""
+        if len(values) != len(self.fields):
+            raise Exception(f"Expected {len(self.fields)} state values, got {len(values)}.")
+        return StateRecord(self, tuple(values))
+
+
+class StateRecord(Mapping):
+    """A decoded state that keeps its values in a tuple and resolves field names through its StateSchema. It can be
+    used like the dict a JSON state decodes to, and its fields can also be read as attributes (state.x)."""
+
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    def __getitem__(self, field):
+        return self.values[self.schema.index[field]]
+
+    def __getattr__(self, field):
+        try:
+            return self.values[self.schema.index[field]]
+        except KeyError:
+            raise AttributeError(field) from None
+
+    def __contains__(self, field):
+        return field in self.schema.index
+
+    def __iter__(self):
+        return iter(self.schema.fields)
+
+    def __len__(self):
+        return len(self.values)
+
+    def to_dict(self):
+        return dict(zip(self.schema.fields, self.values))
+
+    def __repr__(self):
+        return f"StateRecord({self.to_dict()})"
+
+
+class StateHistory:
+    """A preallocated ring buffer of the most recent states of a Cozmo robot, each stored with the wall-clock time it
+    was received and the simulation time it was published at, so that e.g. a camera frame can be lined up with the
+    robot's pose at the moment it was captured without asking the simulator.
+
+    Queries take a clock argument: 'sim' looks states up by simulation time (which requires the published states to
+    carry it, see CozmoStateModule's time_key), 'received' by the time.time() they were received at. Both clocks are
+    assumed to be non-decreasing, so lookups are binary searches.
+
+    Example:\n
+    sim_time = image_iu.meta_data['sim_time']\n
+    pose = state.history.interpolate(sim_time, fields=['x', 'y', 'theta'], angles=['theta'])
+    """
+
+    def __init__(self, capacity=256):
+        """
+        :param capacity: The number of states kept. Once full, each new state overwrites the oldest one.
+        """
+        self.capacity = capacity
+        self._states = [None] * capacity
+        self._times = {'received': array('d', bytes(8 * capacity)), 'sim': array('d', bytes(8 * capacity))}
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self.overwritten = 0
+
+    def append(self, state, received_at=None, sim_time=math.nan):
+        """Adds a state to the history.
+
+        :param state: The state, as a dict or StateRecord.
+        :param received_at: When the state was received. Defaults to now.
+        :param sim_time: The simulation time the state was published at, or NaN if unknown.
+        """
+        with self._lock:
+            if self._count < self.capacity:
+                i = (self._start + self._count) % self.capacity
+                self._count += 1
+            else:
+                i = self._start
+                self._start = (self._start + 1) % self.capacity
+                self.overwritten += 1
+            self._states[i] = state
+            self._times['received'][i] = received_at if received_at is not None else time.time()
+            self._times['sim'][i] = sim_time
+
+    def latest(self):
+        """Returns the most recent entry as a (received_at, sim_time, state) tuple, or None if the history is empty."""
+        with self._lock:
+            if self._count == 0: return None
+            return self._entry(self._count - 1)
+
+    def nearest(self, t, clock='sim'):
+        """Returns the entry closest to t as a (received_at, sim_time, state) tuple, or None if the history is empty.
+
+        :param t: The point in time.
+        :param clock: 'sim' or 'received'.
+        """
+        with self._lock:
+            if self._count == 0: return None
+            times = self._clock(clock)
+            k = self._bisect(times, t)
+            if k == self._count or (k > 0 and t - times[self._index(k - 1)] <= times[self._index(k)] - t):
+                k -= 1
+            return self._entry(k)
+
+    def since(self, t, clock='sim'):
+        """Returns all entries after t, oldest first, as (received_at, sim_time, state) tuples.
+
+        :param t: The point in time.
+        :param clock: 'sim' or 'received'.
+        """
+        with self._lock:
+            if self._count == 0: return []
+            times = self._clock(clock)
+            k = self._bisect(times, t)
+            while k < self._count and times[self._index(k)] <= t:
+                k += 1
+            return [self._entry(j) for j in range(k, self._count)]
+
+    def interpolate(self, t, fields=None, angles=(), clock='sim'):
+        """Linearly interpolates the numeric fields of the two states around t. Outside of the recorded range, the
+        oldest or latest state is used as is.
+
+        :param t: The point in time.
+        :param fields: The fields to interpolate. By default, all int and float fields of the state before t.
+        :param angles: Fields holding angles in radians, which are interpolated along the shorter way around.
+        :param clock: 'sim' or 'received'.
+        :return: A dict of the interpolated fields, or None if the history is empty.
+        """
+        with self._lock:
+            if self._count == 0: return None
+            times = self._clock(clock)
+            k = self._bisect(times, t)
+            if k == self._count:
+                before = after = self._states[self._index(k - 1)]
+                w = 0.0
+            elif k == 0:
+                before = after = self._states[self._index(0)]
+                w = 0.0
+            else:
+                t0, t1 = times[self._index(k - 1)], times[self._index(k)]
+                before, after = self._states[self._index(k - 1)], self._states[self._index(k)]
+                w = (t - t0) / (t1 - t0) if t1 > t0 else 0.0
+
+        if fields is None:
+            fields = [key for key, value in before.items()
+                      if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+        pose = {}
+        for field in fields:
+            a, b = before[field], after[field]
+            delta = b - a
+            if field in angles:
+                delta = (delta + math.pi) % (2 * math.pi) - math.pi
+            pose[field] = a + w * delta
+        return pose
+
+    def __len__(self):
+        return self._count
+
+    def _clock(self, clock):
+        times = self._times[clock]
+        if clock == 'sim' and math.isnan(times[self._index(self._count - 1)]):
+            raise Exception("The recorded states carry no simulation time. Query with clock='received' instead.")
+        return times
+
+    def _index(self, k):
+        return (self._start + k) % self.capacity
+
+    def _bisect(self, times, t):
+        """Returns the index of the first entry at or after t, in order from oldest to newest."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[self._index(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _entry(self, k):
+        i = self._index(k)
+        return self._times['received'][i], self._times['sim'][i], self._states[i]
+
+
 class CozmoStateIU(IncrementalUnit):
     """Attributes:
 
@@ -15,7 +239,7 @@ class CozmoStateIU(IncrementalUnit):
         current one.
     :param grounded_in (IncrementalUnit): A link to the IU this IU is based on.
     :param created_at (float): The UNIX timestamp of the moment the IU is created.
-    :param state (dict): The state of the robot
+    :param state (dict): The state of the robot, as a dict or a StateRecord
     """
 
     @staticmethod
@@ -33,11 +257,7 @@ class CozmoStateIU(IncrementalUnit):
         self.payload = state
 
     def __str__(self):
-        out = "\n{"
-        for key, val in self.payload.items():
-            out += "\n\t" + key + ": " + str(val) + ","
-        out += "\n}"
-        return out
+        return "\n{" + "".join(f"\n\t{key}: {val}," for key, val in self.payload.items()) + "\n}"
 
 class CozmoStateModule(AbstractProducingModule):
     @staticmethod
@@ -52,28 +272,92 @@ class CozmoStateModule(AbstractProducingModule):
     def output_iu():
         return CozmoStateIU
 
-    def __init__(self, robot: Cozmo, pub_ip, port=20001, **kwargs):
+    def __init__(self, robot: Cozmo, pub_ip, port=20001, stepped=False, conflate=False, hwm=None, poll_timeout=100,
+                 encoding='json', schema=None, history_size=256, time_key='sim_time', **kwargs):
+        """
+        :param robot: The Cozmo robot whose state should be tracked.
+        :param pub_ip: The ip of the machine running the simulation.
+        :param port: The port the robot's script publishes its state on.
+        :param stepped: If True, no listener thread is started and states are only received when capture() is called,
+        e.g. by a CoppeliaStepScheduler after each simulation step.
+        :param conflate: If True, the subscriber only keeps the most recent unread state.
+        :param hwm: An optional receive high-water mark, i.e. the number of unread states ZMQ queues before dropping.
+        :param poll_timeout: How many milliseconds the listener and the producing loop block waiting for a new state
+        before checking whether the module is still running.
+        :param encoding: How the robot's script encodes its states: 'json', 'struct' (a fixed layout described by
+        schema) or 'msgpack' (requires the msgpack package). Binary states decode into StateRecords, which are much
+        faster to decode and smaller than dicts. JSON messages are still recognized (by their size and leading '{'),
+        so a script that still publishes JSON keeps working. Messages that can't be decoded are skipped and counted
+        in decode_errors.
+        :param schema: The StateSchema of the published states. Required for 'struct'; for 'msgpack', states published
+        as arrays in schema order become StateRecords, while maps decode to dicts.
+        :param history_size: The number of received states kept in the module's StateHistory.
+        :param time_key: The field of the published states holding the simulation time, used to index the history.
+        """
         super().__init__(**kwargs)
         self.robot = robot
         self.port = port
         self.pub_ip = pub_ip
         self.num_states = 0
         self.num_frames = 0
-        self.state_queue = deque(maxlen=5)
+        self.state_queue = deque(maxlen=5)  # (time received, state) tuples
+        self.dropped = 0  # States that were pushed out of the state queue before they could be sent
+        self.decode_errors = 0  # Messages that couldn't be decoded and were skipped
+        self.history = StateHistory(history_size)
+        self.time_key = time_key
+        self.stepped = stepped
+        self.poll_timeout = poll_timeout
         self._update = False
+        self._new_state = threading.Event()
 
-        client = RemoteAPIClient()
-        self._sim = client.require('sim')
+        labels = {'module': self.name(), 'port': port, 'instance': metrics.instance(self)}
+        self._decode_time = metrics.histogram('cozmo_state_decode_seconds', "Time spent decoding a state", owner=self,
+                                              **labels)
+        self._queue_time = metrics.histogram('cozmo_state_queue_seconds',
+                                             "Time states wait in the state queue before being sent", owner=self,
+                                             **labels)
+        metrics.counter('cozmo_states_dropped', "States pushed out of the state queue before being sent",
+                        fn=lambda m: m.dropped, owner=self, **labels)
+        metrics.counter('cozmo_state_decode_errors', "Messages that couldn't be decoded", fn=lambda m: m.decode_errors,
+                        owner=self, **labels)
+        metrics.gauge('cozmo_states_queued', "States waiting in the state queue", fn=lambda m: len(m.state_queue),
+                      owner=self, **labels)
+
+        if encoding not in ('json', 'struct', 'msgpack'):
+            raise Exception(f"Invalid state encoding {encoding}.")
+        if encoding == 'struct' and schema is None:
+            raise Exception("The 'struct' state encoding requires a schema.")
+        self.encoding = encoding
+        self.schema = schema
+        self._unpackb = None
+        if encoding == 'msgpack':
+            try:
+                import msgpack
+            except ImportError:
+                raise Exception("The 'msgpack' state encoding requires the msgpack package.") from None
+            self._unpackb = msgpack.unpackb
+
+        self._sim = robot.session.sim
 
         context = zmq.Context()
         self.subscriber = context.socket(zmq.SUB)
-        self.subscriber.connect(f"tcp://{pub_ip}:{port}")
+        # Socket options only apply to connections made after they are set
+        if conflate:
+            self.subscriber.setsockopt(zmq.CONFLATE, 1)
+        if hwm is not None:
+            self.subscriber.setsockopt(zmq.RCVHWM, hwm)
         self.subscriber.setsockopt_string(zmq.SUBSCRIBE, '') # Subscribes to all messages
+        self.subscriber.connect(f"tcp://{pub_ip}:{port}")
 
     def process_update(self, um):
-        if len(self.state_queue) == 0: return
+        if len(self.state_queue) == 0:
+            # Block until the listener signals a new state instead of spinning
+            self._new_state.wait(self.poll_timeout / 1000)
+            self._new_state.clear()
+            if len(self.state_queue) == 0: return
 
-        state = self.state_queue.popleft()
+        received_at, state = self.state_queue.popleft()
+        self._queue_time.observe(time.perf_counter() - received_at)
         self.num_states += 1
         output_iu = self.create_iu(None)
         output_iu.set_state(state)
@@ -83,17 +367,74 @@ class CozmoStateModule(AbstractProducingModule):
     def _state_listener(self):
         """Looping/threaded function for fetching state packages from CoppeliaSim."""
 
+        poller = zmq.Poller()
+        poller.register(self.subscriber, zmq.POLLIN)
         while self._update:
-            try:  # Try to receive state package from CoppeliaSim as python dict/json
-                state = self.subscriber.recv_json(zmq.NOBLOCK)
-                self.state_queue.append(state)
+            if poller.poll(self.poll_timeout):
+                self._receive_states()
+
+    def _receive_states(self):
+        """Moves all states waiting on the subscriber into the state queue and signals the producing loop."""
+        while True:
+            try:  # Try to receive state package from CoppeliaSim
+                data = self.subscriber.recv(zmq.NOBLOCK)
+            except zmq.Again:  # No more packages
+                break
+            received_at = time.perf_counter()
+            try:
+                state = self.decode_state(data)
+            except Exception as e:
+                # A single malformed message must not end the listener
+                if self.decode_errors == 0:
+                    print(f"Could not decode Cozmo state: {e}")
+                self.decode_errors += 1
+                continue
+            self._decode_time.observe(time.perf_counter() - received_at)
+            if len(self.state_queue) == self.state_queue.maxlen:
+                self.dropped += 1
+            self.state_queue.append((received_at, state))
+            self.history.append(state, time.time(), state.get(self.time_key, math.nan))
+            self.robot.notify_state(state)
+        self._new_state.set()
+
+    def decode_state(self, data):
+        """Decodes a state message according to the module's encoding, falling back to JSON for binary messages that
+        start with '{' and can't be states of the module's encoding (struct messages of the wrong size, msgpack
+        messages don't start with '{').
 
-            except zmq.Again:  # No package
-                pass
+        :param data: The raw bytes received from the robot's script.
+        :return: A StateRecord, or a dict for JSON and msgpack map states.
+        """
+        if self.encoding == 'json':
+            return json.loads(data)
+        if self.encoding == 'struct':
+            if len(data) == self.schema.struct.size:
+                return self.schema.unpack(data)
+            if data[:1] == b'{':
+                return json.loads(data)
+            raise Exception(f"Expected a {self.schema.struct.size} byte state, got {len(data)} bytes.")
+
+        if data[:1] == b'{':
+            return json.loads(data)
+        state = self._unpackb(data)
+        if isinstance(state, list):
+            if self.schema is None:
+                raise Exception("Decoding msgpack array states requires a schema.")
+            return self.schema.record(state)
+        if not isinstance(state, dict):
+            raise Exception(f"Expected a msgpack map or array state, got {type(state).__name__}.")
+        return state
+
+    def capture(self, timeout=100):
+        """Receives the states published since the last call, waiting up to timeout milliseconds for the first one."""
+        if self.subscriber.poll(timeout):
+            self._receive_states()
 
     def setup(self):
         self.robot.set_zmq_port(self.port)  # Binds a specific simulation robot to the port to communicate on
         print(f"Connected to publisher at {self.pub_ip}:{self.port}")
+        if self.stepped: return
+
         self._update = True
         threading.Thread(target=self._state_listener, daemon=True).start()
 
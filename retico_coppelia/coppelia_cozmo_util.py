@@ -1,11 +1,38 @@
+import math
 from abc import ABC, abstractmethod
 import numpy as np
 import retico_core
 
+# The unit types below are created for every command, so they use __slots__ and plain float math for scalars. Each
+# of them also accepts a numpy array (or a list), e.g. a whole trajectory of angles, which converts in a single
+# vectorized call.
+_ARRAY_TYPES = (np.ndarray, list, tuple)
+
+
+def _radians(value):
+    if isinstance(value, _ARRAY_TYPES):
+        return np.radians(value)
+    return math.radians(value)
+
+
+def _degrees(value):
+    if isinstance(value, _ARRAY_TYPES):
+        return np.degrees(value)
+    return math.degrees(value)
+
+
+def _native(value):
+    """Returns scalars as native floats, which serialize over the remote API as is, and arrays (lists as arrays)."""
+    if isinstance(value, _ARRAY_TYPES):
+        return np.asarray(value)
+    return float(value)
+
 
 class AngularSpeed(ABC):
+    __slots__ = ('rate',)
+
     def __init__(self, rate):
-        if rate < 0:
+        if np.any(np.asarray(rate) < 0) if isinstance(rate, _ARRAY_TYPES) else rate < 0:
             raise Exception("Can't pass negative value for speed.")
 
         self.rate = rate
@@ -20,36 +47,38 @@ class AngularSpeed(ABC):
 
 
 class DPS(AngularSpeed):
-    def __init__(self, rate):
-        super().__init__(rate)
+    __slots__ = ()
 
     def to_rads(self):
-        return np.radians(self.rate)
+        return _radians(self.rate)
 
     def to_dps(self):
-        return self.rate
+        return _native(self.rate)
 
 
 class Rads(AngularSpeed):
-    def __init__(self, rate):
-        super().__init__(rate)
+    __slots__ = ()
 
     def to_rads(self):
-        return self.rate
+        return _native(self.rate)
 
     def to_dps(self):
-        return np.degrees(self.rate)
+        return _degrees(self.rate)
 
 
 class MMPS:
+    __slots__ = ('rate',)
+
     def __init__(self, rate):
         self.rate = rate
 
     def to_mmps(self):
-        return self.rate
+        return _native(self.rate)
 
 
 class Angle(ABC):
+    __slots__ = ('magnitude',)
+
     def __init__(self, magnitude):
         self.magnitude = magnitude
 
@@ -59,28 +88,28 @@ class Angle(ABC):
 
 
 class Degrees(Angle):
-    def __init__(self, magnitude):
-        super().__init__(magnitude)
+    __slots__ = ()
 
     def to_radians(self):
-        return np.radians(self.magnitude)
+        return _radians(self.magnitude)
 
     def to_degrees(self):
-        return self.magnitude
+        return _native(self.magnitude)
 
 
 class Radians(Angle):
-    def __init__(self, magnitude):
-        super().__init__(magnitude)
+    __slots__ = ()
 
     def to_radians(self):
-        return self.magnitude
+        return _native(self.magnitude)
 
     def to_degrees(self):
-        return np.degrees(self.magnitude)
+        return _degrees(self.magnitude)
 
 
 class Distance(ABC):
+    __slots__ = ('magnitude',)
+
     def __init__(self, magnitude):
         self.magnitude = magnitude
 
@@ -90,8 +119,7 @@ class Distance(ABC):
 
 
 class Millimeters(Distance):
-    def __init__(self, magnitude):
-        super().__init__(magnitude)
+    __slots__ = ()
 
     def to_mm(self):
-        return self.magnitude
+        return _native(self.magnitude)
@@ -0,0 +1,362 @@
+import math
+import threading
+import time
+import numpy as np
+import zmq
+
+
+class FakeSim:
+    """A stand-in for the 'sim' object of a CoppeliaSim remote API client, for running the modules (and the benchmarks
+    in benchmarks/) without a simulator.
+
+    It implements the calls the modules make: loading and starting scenes, stepping, joint targets, vision sensor
+    images and the script functions of a Cozmo robot (including the helpers the modules define in Lua). Every call can
+    be delayed by a fixed latency to model the round trip to a real simulator. Unless stepping is enabled, the
+    simulation time follows the wall clock in steps of time_step.
+    """
+
+    scripttype_sandbox = 0
+    scripttype_simulation = 1
+
+    def __init__(self, latency=0.0, resolution=(256, 256), time_step=0.05, state_rate=100.0, state_encoding='json',
+                 state_schema=None):
+        """
+        :param latency: How many seconds every call takes.
+        :param resolution: The (width, height) of the vision sensor images.
+        :param time_step: The simulation time step in seconds.
+        :param state_rate: How many states per second the Cozmo robot publishes once its ZMQ port is bound.
+        :param state_encoding: 'json' or 'struct'. See FakeStatePublisher.
+        :param state_schema: The StateSchema of struct states.
+        """
+        self.latency = latency
+        self.resolution = tuple(resolution)
+        self.time_step = time_step
+        self.state_rate = state_rate
+        self.state_encoding = state_encoding
+        self.state_schema = state_schema
+        self.calls = 0
+        self.require_calls = 0
+        self.joint_targets = {}
+        self.publishers = {}
+        self.pose = {'x': 0.0, 'y': 0.0, 'theta': 0.0, 'head_angle': 0.0, 'lift_height': 0.0}
+
+        self._objects = {}
+        self._stepping = False
+        self._running = False
+        self._started_at = None
+        self._steps = 0
+        self._moving_until = 0.0
+        self._sequences = []
+        self._settling = {}
+        self._lock = threading.RLock()
+
+        width, height = self.resolution
+        rng = np.random.default_rng(0)
+        # Two alternating frames, so that consecutive frames differ as they would in a running scene
+        self._frames = [rng.integers(0, 256, width * height * 3, dtype=np.uint8).tobytes() for _ in range(2)]
+
+    def _call(self):
+        self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    # Scenes and simulation time
+
+    def loadScene(self, scene):
+        self._call()
+        with self._lock:
+            self._objects.clear()
+
+    def startSimulation(self):
+        self._call()
+        with self._lock:
+            self._running = True
+            self._started_at = time.perf_counter()
+            self._steps = 0
+
+    def stopSimulation(self):
+        self._call()
+        with self._lock:
+            self._running = False
+            publishers, self.publishers = self.publishers, {}
+        # Outside of the lock, which the publisher threads need to finish
+        for publisher in publishers.values():
+            publisher.stop()
+
+    def setStepping(self, enabled):
+        self._call()
+        self._stepping = enabled
+
+    def step(self):
+        self._call()
+        with self._lock:
+            self._steps += 1
+            self._advance_sequences()
+
+    def getSimulationTimeStep(self):
+        self._call()
+        return self.time_step
+
+    def getSimulationTime(self):
+        self._call()
+        return self.sim_time()
+
+    def sim_time(self):
+        """Returns the current simulation time without counting as a remote call."""
+        if not self._stepping and self._running:
+            self._steps = int((time.perf_counter() - self._started_at) / self.time_step)
+        return self._steps * self.time_step
+
+    # Objects and joints
+
+    def getObject(self, path):
+        self._call()
+        with self._lock:
+            return self._objects.setdefault(path, len(self._objects) + 1)
+
+    def removeObjects(self, handles):
+        self._call()
+        with self._lock:
+            for path, handle in list(self._objects.items()):
+                if handle in handles:
+                    del self._objects[path]
+
+    def setJointTargetPosition(self, handle, value):
+        self._call()
+        self.joint_targets[handle] = (0, value)
+
+    def setJointTargetVelocity(self, handle, value):
+        self._call()
+        self.joint_targets[handle] = (1, value)
+
+    def setJointTargetForce(self, handle, value):
+        self._call()
+        self.joint_targets[handle] = (2, value)
+
+    # Vision sensors
+
+    def getVisionSensorRes(self, handle):
+        self._call()
+        return list(self.resolution)
+
+    def getVisionSensorImg(self, handle, options=0, cutoff=0.0, pos=None, size=None):
+        self._call()
+        return self._image(options, size)
+
+    def _image(self, options, size):
+        width, height = size if size is not None and size[0] > 0 else self.resolution
+        channels = 1 if options & 1 else 3
+        frame = self._frames[int(self.sim_time() / self.time_step) % 2]
+        return frame[:width * height * channels], [width, height]
+
+    # Scripts
+
+    def getScript(self, script_type, path=None):
+        self._call()
+        return script_type
+
+    def initScript(self, script_handle):
+        self._call()
+
+    def executeScriptString(self, source, script_handle):
+        self._call()
+
+    def callScriptFunction(self, name, script_handle, *args):
+        self._call()
+        with self._lock:
+            self._advance_sequences()
+            return getattr(self, '_script_' + name)(*args)
+
+    def _script_retico_setJointTargets(self, handles, values, modes):
+        for handle, value, mode in zip(handles, values, modes):
+            self.joint_targets[handle] = (mode, value)
+
+    def _script_retico_getVisionSensorImgs(self, handles, options, positions, sizes):
+        images = [self._image(options, size) for size in sizes]
+        return [image for image, _ in images], [res for _, res in images], self.sim_time()
+
+    # The functions of the Cozmo robot's script. Every motion takes as long as it would at the given speed.
+
+    def _script_bind_zmq(self, port):
+        if port not in self.publishers:
+            publisher = FakeStatePublisher(self, port, self.state_rate, self.state_encoding, self.state_schema)
+            publisher.start()
+            self.publishers[port] = publisher
+
+    def _script_is_moving(self):
+        return self.sim_time() < self._moving_until
+
+    def _script_stop(self):
+        self._moving_until = 0.0
+
+    def _move(self, amount, speed):
+        self._moving_until = self.sim_time() + (abs(amount) / speed if speed > 0 else 0.0)
+
+    def _script_turn_in_place(self, angle, speed):
+        self.pose['theta'] = (self.pose['theta'] + angle + math.pi) % (2 * math.pi) - math.pi
+        self._move(angle, speed)
+
+    def _script_set_head_angle(self, angle, speed):
+        self._move(angle - self.pose['head_angle'], speed)
+        self.pose['head_angle'] = angle
+
+    def _script_set_lift_height(self, height, speed):
+        self._move(height - self.pose['lift_height'], speed)
+        self.pose['lift_height'] = height
+
+    def _script_drive_straight(self, distance, speed):
+        self.pose['x'] += distance * math.cos(self.pose['theta'])
+        self.pose['y'] += distance * math.sin(self.pose['theta'])
+        self._move(distance, speed)
+
+    # The sequencer that Cozmo.run_sequence() injects into the robot's script
+
+    def _script_retico_run_sequence(self, sequence_id, commands):
+        self._sequences.append({'id': sequence_id, 'commands': commands, 'index': 0, 'waiting': False,
+                                'issued': False})
+        self._advance_sequences()
+        return self._script_retico_sequence_pending(sequence_id)
+
+    def _script_retico_sequence_pending(self, sequence_id):
+        return sequence_id in self._settling or any(sequence['id'] == sequence_id for sequence in self._sequences)
+
+    def _script_retico_pending_sequences(self):
+        return [sequence['id'] for sequence in self._sequences] + list(self._settling)
+
+    def _script_retico_cancel_sequence(self, sequence_id):
+        status = 'started' if self._settling.pop(sequence_id, None) is not None else None
+        for sequence in self._sequences:
+            if sequence['id'] == sequence_id:
+                status = 'started' if sequence['index'] > 0 else status or 'queued'
+        self._sequences = [sequence for sequence in self._sequences if sequence['id'] != sequence_id]
+        return status
+
+    def _advance_sequences(self):
+        # Mirrors retico_advance_sequences() in coppelia_cozmo.py
+        now = self.sim_time()
+        if len(self._settling) > 0 and not self._script_is_moving():
+            self._settling = {id: issued_at for id, issued_at in self._settling.items() if issued_at >= now}
+        while len(self._sequences) > 0:
+            sequence = self._sequences[0]
+            if sequence['waiting']:
+                if self._script_is_moving(): return
+                sequence['waiting'] = False
+                sequence['issued'] = False
+            if sequence['index'] == len(sequence['commands']):
+                self._sequences.pop(0)
+                if sequence['issued']:
+                    self._settling[sequence['id']] = now
+                continue
+            function, a, b, wait = sequence['commands'][sequence['index']]
+            getattr(self, '_script_' + function)(a, b)
+            sequence['index'] += 1
+            sequence['issued'] = True
+            if wait:
+                sequence['waiting'] = True
+                return
+
+    def cozmo_state(self):
+        """Returns the state the Cozmo robot currently publishes."""
+        with self._lock:
+            self._advance_sequences()
+            state = dict(self.pose)
+            state['is_moving'] = self._script_is_moving()
+            state['sim_time'] = self.sim_time()
+        return state
+
+
+class FakeRemoteAPIClient:
+    """A drop-in replacement for RemoteAPIClient that talks to a FakeSim, e.g. CoppeliaSession(client_factory=
+    FakeRemoteAPIClient). All clients created for the same host and port share one FakeSim, like the clients of a real
+    simulator do."""
+
+    _sims = {}
+    _sims_lock = threading.Lock()
+
+    def __init__(self, host='localhost', port=23000, sim=None, **kwargs):
+        """
+        :param host: The host of the simulator being faked.
+        :param port: The port of the simulator being faked.
+        :param sim: The FakeSim to use. By default, the one shared for host and port, created with kwargs on first use.
+        """
+        if sim is None:
+            with FakeRemoteAPIClient._sims_lock:
+                sim = FakeRemoteAPIClient._sims.get((host, port))
+                if sim is None:
+                    sim = FakeSim(**kwargs)
+                    FakeRemoteAPIClient._sims[(host, port)] = sim
+        self.sim = sim
+
+    @classmethod
+    def factory(cls, sim):
+        """Returns a client_factory for CoppeliaSession that creates clients for the given FakeSim."""
+        return lambda host, port: cls(host, port, sim=sim)
+
+    def require(self, name):
+        """Like RemoteAPIClient.require(), which resolves the object anew on every call, this costs two remote calls
+        (zmqRemoteApi.require and zmqRemoteApi.info), counted in sim.calls and sim.require_calls."""
+        if name != 'sim':
+            raise Exception(f"FakeRemoteAPIClient does not provide '{name}'.")
+        self.sim._call()
+        self.sim._call()
+        self.sim.require_calls += 1
+        return self.sim
+
+
+class FakeStatePublisher:
+    """Publishes the state of a FakeSim's Cozmo robot on a local ZMQ PUB socket, like the robot's script does. Each
+    state also carries the wall-clock time it was sent at under 'sent_at', for measuring latency."""
+
+    def __init__(self, sim, port, rate=100.0, encoding='json', schema=None):
+        """
+        :param sim: The FakeSim whose robot state is published.
+        :param port: The port to bind the publisher to.
+        :param rate: How many states to publish per second. If None, states are published as fast as possible.
+        :param encoding: 'json', or 'struct' to pack the states according to schema.
+        :param schema: The StateSchema of struct states. Fields the robot doesn't have are published as 0.
+        """
+        if encoding == 'struct' and schema is None:
+            raise Exception("The 'struct' state encoding requires a schema.")
+        self.sim = sim
+        self.port = port
+        self.rate = rate
+        self.encoding = encoding
+        self.schema = schema
+        self.published = 0
+        self._running = False
+        self._thread = None
+
+        self._socket = zmq.Context.instance().socket(zmq.PUB)
+        self._socket.bind(f"tcp://*:{port}")
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._publish_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._socket.close(linger=0)
+
+    def _publish_loop(self):
+        interval = 1.0 / self.rate if self.rate else None
+        next_publish = time.perf_counter()
+        while self._running:
+            state = self.sim.cozmo_state()
+            state['sent_at'] = time.time()
+            if self.encoding == 'struct':
+                self._socket.send(self.schema.struct.pack(*(state.get(field, 0) for field in self.schema.fields)))
+            else:
+                self._socket.send_json(state)
+            self.published += 1
+
+            if interval is not None:
+                next_publish += interval
+                delay = next_publish - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_publish = time.perf_counter()
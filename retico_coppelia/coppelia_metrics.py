@@ -0,0 +1,261 @@
+import os
+import sys
+import itertools
+import threading
+import weakref
+from bisect import bisect_left
+
+# Bucket upper bounds in seconds, from 10 microseconds to 10 seconds
+DEFAULT_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """A histogram of durations in seconds with fixed bucket bounds. Observing is a bisect and three increments."""
+
+    def __init__(self, registry, name, labels, help='', buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        if not self.registry.enabled: return
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Estimates the q-quantile as the upper bound of the bucket it falls into."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+
+class Counter:
+    """A monotonically increasing count. If fn is given, the value is read from it when metrics are collected, which
+    exposes counters a module already keeps (e.g. JointCommandBuffer.dropped) without touching its hot path. If fn
+    returns None (its owner is gone, see MetricsRegistry.counter()), the last value read is kept."""
+
+    def __init__(self, registry, name, labels, help='', fn=None):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.fn = fn
+        self._value = 0
+
+    def inc(self, amount=1):
+        if not self.registry.enabled: return
+        self._value += amount
+
+    @property
+    def value(self):
+        if self.fn is not None:
+            value = self.fn()
+            if value is not None:
+                self._value = value
+        return self._value
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    """A value that can go up and down, such as a queue depth. Like Counter, it can read its value from fn."""
+
+    def set(self, value):
+        if not self.registry.enabled: return
+        self._value = value
+
+
+class MetricsRegistry:
+    """Holds the metrics of all Coppelia modules. Metrics are identified by name and labels; asking for an existing one
+    returns it. Modules label their metrics with instance(self), so that every module instance has series of its own,
+    and pass themselves as owner, so that their series are dropped once they are garbage collected.
+
+    Example:\n
+    from retico_coppelia.coppelia_metrics import metrics\n
+    metrics.start_dump(10.0, format='prometheus')\n
+    ...\n
+    print(metrics.snapshot())
+    """
+
+    def __init__(self, enabled=True):
+        """
+        :param enabled: Whether metrics are recorded. When disabled, observations return right away.
+        """
+        self.enabled = enabled
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._instances = itertools.count(1)
+        self._dump_thread = None
+        self._dumping = threading.Event()
+
+    def instance(self, obj):
+        """Returns a label value that is unique to obj for the lifetime of the registry, for the 'instance' label."""
+        return str(next(self._instances))
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, owner=None, **labels):
+        """Returns a Histogram.
+
+        :param owner: The object the histogram belongs to, if any. The histogram is removed from the registry once
+        owner is garbage collected.
+        """
+        return self._get(Histogram, name, labels, owner, help=help, buckets=buckets)
+
+    def counter(self, name, help='', fn=None, owner=None, **labels):
+        """Returns a Counter.
+
+        :param fn: An optional function returning the counter's value.
+        :param owner: The object the counter belongs to, if any. If given, fn is called as fn(owner), with owner only
+        referenced weakly, so that the registry doesn't keep it alive, and the counter is removed from the registry
+        once owner is garbage collected.
+        """
+        return self._get(Counter, name, labels, owner, help=help, fn=_bind(fn, owner))
+
+    def gauge(self, name, help='', fn=None, owner=None, **labels):
+        """Returns a Gauge. fn and owner work as for counter()."""
+        return self._get(Gauge, name, labels, owner, help=help, fn=_bind(fn, owner))
+
+    def _get(self, cls, name, labels, owner, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(self, name, key[1], **kwargs)
+                self._metrics[key] = metric
+                if owner is not None:
+                    weakref.finalize(owner, self._remove, key, metric)
+            elif kwargs.get('fn') is not None:
+                # A new module instance with the same labels takes over the callback
+                metric.fn = kwargs['fn']
+        return metric
+
+    def _remove(self, key, metric):
+        with self._lock:
+            if self._metrics.get(key) is metric:
+                del self._metrics[key]
+
+    def reset(self):
+        """Drops all metrics."""
+        with self._lock:
+            self._metrics.clear()
+
+    def snapshot(self):
+        """Returns the current values of all metrics as a dict keyed by name and labels."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {_series(metric.name, metric.labels): metric.snapshot() for metric in metrics}
+
+    def to_text(self):
+        """Formats all metrics as human-readable text, one line per metric, with latencies in milliseconds."""
+        lines = []
+        for series, value in sorted(self.snapshot().items()):
+            if isinstance(value, dict):
+                if value['count'] == 0:
+                    lines.append(f"{series}: no samples")
+                    continue
+                lines.append(f"{series}: n={value['count']} mean={value['mean'] * 1000:.3f}ms "
+                             f"p50<={value['p50'] * 1000:.3f}ms p90<={value['p90'] * 1000:.3f}ms "
+                             f"p99<={value['p99'] * 1000:.3f}ms")
+            else:
+                lines.append(f"{series}: {value}")
+        return "\n".join(lines)
+
+    def to_prometheus(self):
+        """Formats all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: (m.name, m.labels))
+        lines = []
+        described = set()
+        for metric in metrics:
+            kind = 'histogram' if isinstance(metric, Histogram) else 'gauge' if isinstance(metric, Gauge) else 'counter'
+            if metric.name not in described:
+                described.add(metric.name)
+                if metric.help:
+                    lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {kind}")
+
+            if kind != 'histogram':
+                lines.append(f"{_series(metric.name, metric.labels)} {metric.value}")
+                continue
+
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), metric.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{_series(metric.name + '_bucket', metric.labels + (('le', le),))} {cumulative}")
+            lines.append(f"{_series(metric.name + '_sum', metric.labels)} {metric.sum}")
+            lines.append(f"{_series(metric.name + '_count', metric.labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+    def start_dump(self, interval=10.0, file=None, format='text'):
+        """Periodically writes all metrics from a background thread.
+
+        :param interval: Seconds between dumps.
+        :param file: A path to overwrite with every dump (e.g. for a node exporter's textfile collector), or None to
+        print to stdout.
+        :param format: 'text' or 'prometheus'.
+        """
+        self.stop_dump()
+        self._dumping.clear()
+        self._dump_thread = threading.Thread(target=self._dump_loop, args=[interval, file, format], daemon=True)
+        self._dump_thread.start()
+
+    def stop_dump(self):
+        if self._dump_thread is not None:
+            self._dumping.set()
+            self._dump_thread.join()
+            self._dump_thread = None
+
+    def _dump_loop(self, interval, file, format):
+        while not self._dumping.wait(interval):
+            out = self.to_prometheus() if format == 'prometheus' else self.to_text() + "\n"
+            if file is None:
+                sys.stdout.write(out)
+                sys.stdout.flush()
+            else:
+                # Write and rename, so that readers never see a half-written file
+                with open(file + '.tmp', 'w') as f:
+                    f.write(out)
+                os.replace(file + '.tmp', file)
+
+
+def _bind(fn, owner):
+    if fn is None or owner is None:
+        return fn
+    ref = weakref.ref(owner)
+
+    def read():
+        obj = ref()
+        return fn(obj) if obj is not None else None
+    return read
+
+
+def _series(name, labels):
+    if len(labels) == 0:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# The registry all modules record into. Set RETICO_COPPELIA_METRICS=0 (or metrics.enabled = False) to turn it off.
+metrics = MetricsRegistry(enabled=os.environ.get('RETICO_COPPELIA_METRICS', '1') != '0')
@@ -0,0 +1,333 @@
+import json
+import math
+import mmap
+import os
+import threading
+import time
+import numpy as np
+import retico_core
+from retico_coppelia.coppelia_camera import EncodedImageIU, MultiImageIU
+from retico_coppelia.coppelia_cozmo_state import CozmoStateIU, StateRecord, StateSchema
+from retico_vision.vision import ImageIU
+
+# A recording consists of three files: <path>.data holds the records back to back, <path>.idx holds one fixed-size
+# INDEX_DTYPE entry per record and <path>.json describes the stream. Both the data and the index file are only ever
+# appended to, so a recording that was cut short is still readable up to its last complete index entry.
+INDEX_DTYPE = np.dtype([
+    ('received_at', '<f8'),  # The UNIX time the record was created at
+    ('sim_time', '<f8'),  # The simulation time of the record, or NaN
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('height', '<u2'),  # Only used for raw frames
+    ('width', '<u2'),
+    ('channels', '<u1'),
+    ('kind', '<u1'),
+])
+
+KIND_RAW, KIND_JPEG, KIND_PNG, KIND_JSON, KIND_STRUCT = range(5)
+_ENCODED_KINDS = {'jpeg': KIND_JPEG, 'png': KIND_PNG}
+
+
+class StreamWriter:
+    """Appends timestamped records to a recording. See INDEX_DTYPE for the layout."""
+
+    def __init__(self, path, stream, **header):
+        """
+        :param path: The path of the recording, without extension.
+        :param stream: The kind of stream, 'camera' or 'state'.
+        :param header: Further information about the stream, stored in <path>.json.
+        """
+        self.path = path
+        self.header = dict(header, version=1, stream=stream)
+        self.records = 0
+        self._data = open(path + '.data', 'wb')
+        self._index = open(path + '.idx', 'wb')
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._write_header()
+
+    def _write_header(self):
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.header, f)
+
+    def set_header(self, **header):
+        self.header.update(header)
+        self._write_header()
+
+    def write(self, data, kind, received_at, sim_time=math.nan, shape=(0, 0, 0)):
+        """Appends a record.
+
+        :param data: The record as bytes or any other buffer.
+        :param kind: One of the KIND_* constants.
+        :param received_at: The UNIX time of the record.
+        :param sim_time: The simulation time of the record, if known.
+        :param shape: The (height, width, channels) of raw frames.
+        """
+        entry = np.zeros(1, dtype=INDEX_DTYPE)
+        with self._lock:
+            length = self._data.write(data)
+            entry[0] = (received_at, sim_time, self._offset, length, shape[0], shape[1], shape[2], kind)
+            self._offset += length
+            # The data has to be on disk before the index entry that points to it
+            self._data.flush()
+            self._index.write(entry.tobytes())
+            self._index.flush()
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+
+class StreamReader:
+    """Reads a recording through a memory map. Raw frames are returned as read-only numpy views of the map, and
+    encoded frames as memoryviews, so reading a record neither copies nor decodes it."""
+
+    def __init__(self, path):
+        """
+        :param path: The path of the recording, without extension.
+        """
+        self.path = path
+        with open(path + '.json') as f:
+            self.header = json.load(f)
+        self.schema = None
+        if self.header.get('schema') is not None:
+            self.schema = StateSchema(self.header['schema']['fields'], self.header['schema']['fmt'])
+
+        self._file = open(path + '.data', 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+        index_size = os.path.getsize(path + '.idx') // INDEX_DTYPE.itemsize
+        self.index = np.fromfile(path + '.idx', dtype=INDEX_DTYPE, count=index_size)
+        # Drop entries whose data didn't make it to disk
+        self.index = self.index[self.index['offset'] + self.index['length'] <= size]
+
+    def __len__(self):
+        return len(self.index)
+
+    def record(self, i):
+        """Returns record i, as stored, without copying it.
+
+        :return: A (data, entry) tuple, where entry is the record's INDEX_DTYPE entry.
+        """
+        entry = self.index[i]
+        offset, length = int(entry['offset']), int(entry['length'])
+        return memoryview(self._map)[offset:offset + length], entry
+
+    def frame(self, i):
+        """Returns frame i as a read-only numpy view for raw frames, or as a memoryview of the encoded bytes."""
+        data, entry = self.record(i)
+        if entry['kind'] != KIND_RAW:
+            return data
+        shape = (int(entry['height']), int(entry['width']))
+        if entry['channels'] > 1:
+            shape += (int(entry['channels']),)
+        return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+    def state(self, i):
+        """Returns state i as a StateRecord for struct states or as a dict for JSON states."""
+        data, entry = self.record(i)
+        if entry['kind'] == KIND_STRUCT:
+            return self.schema.unpack(data)
+        return json.loads(bytes(data))
+
+    def close(self):
+        self.index = self.index[:0]
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:  # Frames handed out are still in use; the map is closed once they are collected
+                pass
+        self._file.close()
+
+
+class _RecorderModule(retico_core.AbstractConsumingModule):
+
+    @staticmethod
+    def output_iu():
+        return None
+
+    def __init__(self, path, **kwargs):
+        """
+        :param path: The path of the recording, without extension. Existing files are overwritten.
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self.writer = None
+
+    def process_update(self, update_message):
+        for iu, ut in update_message:
+            if ut == retico_core.UpdateType.ADD:
+                self.record(iu)
+
+    def shutdown(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class CameraRecorderModule(_RecorderModule):
+    """Records the frames of ImageIUs, e.g. from a CoppeliaCameraModule, for replay with a ReplayCameraModule. Raw
+    frames are stored as they are; JPEG and PNG frames are stored encoded."""
+
+    @staticmethod
+    def name():
+        return "Camera Recorder Module"
+
+    @staticmethod
+    def description():
+        return "A module that records camera frames to a memory-mapped log"
+
+    @staticmethod
+    def input_ius():
+        return [ImageIU]
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self.writer = StreamWriter(path, 'camera')
+        self._warned = False
+
+    def record(self, iu):
+        if isinstance(iu, MultiImageIU):
+            if not self._warned:
+                print("Warning: CameraRecorderModule can't record MultiImageIUs. Use combined=False to record frames.")
+                self._warned = True
+            return
+
+        sim_time = iu.meta_data.get('sim_time')
+        sim_time = sim_time if sim_time is not None else math.nan
+        encoding = getattr(iu, 'encoding', None)
+        if encoding is not None:
+            self.writer.write(iu.image, _ENCODED_KINDS[encoding], iu.created_at, sim_time)
+            return
+
+        img = np.ascontiguousarray(iu.image if isinstance(iu.image, np.ndarray) else np.asarray(iu.image))
+        shape = img.shape + (1,) if img.ndim == 2 else img.shape
+        self.writer.write(img, KIND_RAW, iu.created_at, sim_time, shape)
+
+
+class StateRecorderModule(_RecorderModule):
+    """Records CozmoStateIUs, e.g. from a CozmoStateModule, for replay with a ReplayStateModule. StateRecords are
+    stored packed according to their schema, dicts as JSON."""
+
+    @staticmethod
+    def name():
+        return "State Recorder Module"
+
+    @staticmethod
+    def description():
+        return "A module that records Cozmo states to a memory-mapped log"
+
+    @staticmethod
+    def input_ius():
+        return [CozmoStateIU]
+
+    def __init__(self, path, time_key='sim_time', **kwargs):
+        """
+        :param path: The path of the recording, without extension. Existing files are overwritten.
+        :param time_key: The field of the states holding the simulation time.
+        """
+        super().__init__(path, **kwargs)
+        self.time_key = time_key
+        self.writer = StreamWriter(path, 'state', time_key=time_key)
+
+    def record(self, iu):
+        state = iu.payload
+        sim_time = state.get(self.time_key, math.nan)
+        if isinstance(state, StateRecord):
+            if 'schema' not in self.writer.header:
+                self.writer.set_header(schema={'fields': list(state.schema.fields), 'fmt': state.schema.struct.format})
+            self.writer.write(state.schema.struct.pack(*state.values), KIND_STRUCT, iu.created_at, sim_time)
+        else:
+            self.writer.write(json.dumps(state).encode(), KIND_JSON, iu.created_at, sim_time)
+
+
+class _ReplayModule(retico_core.AbstractProducingModule):
+
+    def __init__(self, path, rate=1.0, loop=False, idle_interval=0.1, **kwargs):
+        """
+        :param path: The path of the recording, without extension.
+        :param rate: How many times faster than recorded to replay, e.g. 1.0 for real time. If None, records are
+        emitted as fast as possible.
+        :param loop: Whether to start over at the end of the recording.
+        :param idle_interval: How long to sleep between checks once the recording is finished.
+        """
+        super().__init__(**kwargs)
+        self.reader = StreamReader(path)
+        self.rate = rate
+        self.loop = loop
+        self.idle_interval = idle_interval
+        self.position = 0
+        self.finished = len(self.reader) == 0
+        self._started_at = None
+
+    def process_update(self, um):
+        if self.finished:
+            time.sleep(self.idle_interval)
+            return None
+
+        if self.rate is not None:
+            if self._started_at is None or self.position == 0:
+                self._started_at = time.perf_counter()
+            recorded = self.reader.index['received_at']
+            due = self._started_at + (recorded[self.position] - recorded[0]) / self.rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        output_iu = self.create_iu(None)
+        self.fill(output_iu, self.position)
+        self.position += 1
+        if self.position == len(self.reader):
+            self.position = 0
+            self.finished = not self.loop
+        return retico_core.UpdateMessage.from_iu(output_iu, retico_core.UpdateType.ADD)
+
+    def shutdown(self):
+        self.reader.close()
+
+
+class ReplayCameraModule(_ReplayModule):
+    """Replays a recording made by a CameraRecorderModule as ImageIUs (or EncodedImageIUs for encoded frames), with
+    the recorded 'sim_time' in their meta_data. Raw frames are read-only numpy views of the memory-mapped recording."""
+
+    @staticmethod
+    def name():
+        return "Replay Camera Module"
+
+    @staticmethod
+    def description():
+        return "A module that replays recorded camera frames"
+
+    def output_iu(self):
+        return ImageIU if self._raw else EncodedImageIU
+
+    def __init__(self, path, rate=1.0, loop=False, **kwargs):
+        self._raw = True
+        super().__init__(path, rate, loop, **kwargs)
+        self._raw = len(self.reader) == 0 or self.reader.index['kind'][0] == KIND_RAW
+
+    def fill(self, output_iu, i):
+        output_iu.set_image(self.reader.frame(i), 1, -1)
+        output_iu.meta_data['sim_time'] = float(self.reader.index['sim_time'][i])
+        if not self._raw:
+            output_iu.encoding = 'jpeg' if self.reader.index['kind'][i] == KIND_JPEG else 'png'
+
+
+class ReplayStateModule(_ReplayModule):
+    """Replays a recording made by a StateRecorderModule as CozmoStateIUs."""
+
+    @staticmethod
+    def name():
+        return "Replay State Module"
+
+    @staticmethod
+    def description():
+        return "A module that replays recorded Cozmo states"
+
+    @staticmethod
+    def output_iu():
+        return CozmoStateIU
+
+    def fill(self, output_iu, i):
+        output_iu.set_state(self.reader.state(i))
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import threading
+import weakref
+
+
+class SceneManager:
+    """Owns the scene and the simulation lifecycle of one CoppeliaSim instance, so that modules sharing a session
+    don't each reload the scene or stop the simulation under each other's feet. Every CoppeliaSession has one, as
+    session.scenes.
+
+    A scene is only loaded if it differs from the loaded one, by path and, for scene files that exist locally, by
+    content hash. Starting and stopping are reference counted: the simulation starts with the first start() and stops
+    with the last matching stop(). Whenever a scene is loaded, the registered listeners are called, so modules can
+    drop handles that belonged to the previous scene.
+    """
+
+    def __init__(self, sim):
+        """
+        :param sim: The 'sim' object of the session.
+        """
+        self._sim = sim
+        self.scene = None  # The (path, content hash) of the loaded scene
+        self.loads = 0
+        self._starts = 0
+        self._hashes = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    def load(self, scene, force=False):
+        """Loads scene unless it is already loaded.
+
+        :param scene: The path of the scene file.
+        :param force: Whether to reload the scene even if it is already loaded, e.g. to reset it.
+        :return: Whether the scene was loaded.
+        """
+        key = (os.path.abspath(scene) if os.path.exists(scene) else scene, self._hash(scene))
+        with self._lock:
+            if key == self.scene and not force:
+                return False
+            if self._starts > 0:
+                raise Exception(f"Can't load {scene} while the simulation of {self.scene[0]} is running.")
+            self._sim.loadScene(scene)
+            self.scene = key
+            self.loads += 1
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            callback = listener()
+            if callback is not None:
+                callback(scene)
+        return True
+
+    def start(self):
+        """Starts the simulation if no other module has started it yet."""
+        with self._lock:
+            self._starts += 1
+            if self._starts == 1:
+                print("Starting simulation...")
+                self._sim.startSimulation()
+
+    def stop(self):
+        """Stops the simulation once every module that called start() has called stop()."""
+        with self._lock:
+            if self._starts == 0: return
+            self._starts -= 1
+            if self._starts == 0:
+                print("Stopping simulation...")
+                self._sim.stopSimulation()
+
+    @property
+    def running(self):
+        return self._starts > 0
+
+    def add_listener(self, callback):
+        """Registers callback(scene) to be called after every scene load. Bound methods are only referenced weakly, so
+        registering doesn't keep a module alive."""
+        with self._lock:
+            if hasattr(callback, '__self__'):
+                self._listeners.append(weakref.WeakMethod(callback))
+            else:
+                self._listeners.append(lambda: callback)
+
+    def _hash(self, scene):
+        """Returns the SHA-1 of a local scene file, cached by modification time and size, or None if scene isn't a
+        local file (e.g. a path on the machine running the simulator)."""
+        try:
+            stat = os.stat(scene)
+        except OSError:
+            return None
+        key = (scene, stat.st_mtime_ns, stat.st_size)
+        digest = self._hashes.get(key)
+        if digest is None:
+            sha = hashlib.sha1()
+            with open(scene, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            self._hashes[key] = digest
+        return digest
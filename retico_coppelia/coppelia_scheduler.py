@@ -0,0 +1,106 @@
+import threading
+import time
+from retico_coppelia.coppelia_session import CoppeliaSession
+
+
+class CoppeliaStepScheduler:
+    """Drives a CoppeliaSim simulation in stepping mode, so that the simulation clock only advances when all modules
+    have had their turn.
+
+    Every step, the scheduler first calls flush() on each actuator (e.g. a CoppeliaModule or CoppeliaCozmoModule
+    created with stepped=True), then advances the simulation by one time step, and finally calls capture() on each
+    sensor (e.g. a CoppeliaCameraModule or CozmoStateModule created with stepped=True). Since nothing happens between
+    steps, a run with the same inputs produces the same results regardless of how fast the machine is.
+
+    Example:\n
+    scheduler = CoppeliaStepScheduler(actuators=[coppelia, cozmo], sensors=[cam, state], realtime_factor=None)\n
+    scheduler.start()\n
+    ...\n
+    scheduler.stop()
+    """
+
+    def __init__(self, session=None, actuators=None, sensors=None, realtime_factor=1.0, start_scene=True,
+                 host='localhost', port=23000):
+        """
+        :param session: The CoppeliaSession to step the simulation through. Stepping mode is bound to the remote API
+        client that enabled it, so the session must have a pool_size of 1. By default, the session shared for host and
+        port (see CoppeliaSession.shared()).
+        :param actuators: Modules with a flush() method that are called before each step.
+        :param sensors: Modules with a capture() method that are called after each step.
+        :param realtime_factor: How many times faster than real time the simulation should run. If None, steps are
+        taken as fast as possible.
+        :param start_scene: Whether the scheduler should start (and on stop, stop) the simulation.
+        :param host: The host of the CoppeliaSim instance to connect to if no session is given.
+        :param port: The port of that instance's ZMQ remote API server.
+        """
+        self.session = session if session is not None else CoppeliaSession.shared(host, port)
+        self.sim = self.session.sim
+        self.actuators = list(actuators) if actuators is not None else []
+        self.sensors = list(sensors) if sensors is not None else []
+        self.realtime_factor = realtime_factor
+        self.start_scene = start_scene
+        self.steps = 0
+        self.sim_time = 0.0
+        self._running = False
+        self._thread = None
+
+    def add_actuator(self, module):
+        """Adds a module whose flush() method is called before each step."""
+        self.actuators.append(module)
+
+    def add_sensor(self, module):
+        """Adds a module whose capture() method is called after each step."""
+        self.sensors.append(module)
+
+    def prepare(self):
+        """Switches the simulator to stepping mode and, if start_scene is True, starts the simulation."""
+        self.sim.setStepping(True)
+        if self.start_scene:
+            self.session.scenes.start()
+
+    def step(self):
+        """Flushes the actuators, advances the simulation by one time step and triggers the sensors."""
+        for module in self.actuators:
+            module.flush()
+
+        self.sim.step()
+        self.steps += 1
+        self.sim_time = self.sim.getSimulationTime()
+
+        for module in self.sensors:
+            module.capture()
+
+    def run_steps(self, n):
+        """Takes n steps in the calling thread, paced according to realtime_factor. Call prepare() first."""
+        self._pace(lambda i: i < n)
+
+    def start(self):
+        """Prepares the simulation and keeps stepping it in a background thread until stop() is called."""
+        self.prepare()
+        self._running = True
+        self._thread = threading.Thread(target=self._pace, args=[lambda i: self._running], daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the stepping thread, stops the simulation if start_scene is True and leaves stepping mode."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self.start_scene:
+            self.session.scenes.stop()
+        self.sim.setStepping(False)
+
+    def _pace(self, keep_going):
+        time_step = self.sim.getSimulationTimeStep()
+        start = time.perf_counter()
+        i = 0
+        while keep_going(i):
+            self.step()
+            i += 1
+
+            if self.realtime_factor is not None:
+                delay = start + i * time_step / self.realtime_factor - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
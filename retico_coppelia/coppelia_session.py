@@ -0,0 +1,120 @@
+import queue
+import threading
+from contextlib import contextmanager
+from coppeliasim_zmqremoteapi_client import RemoteAPIClient
+from retico_coppelia.coppelia_scene import SceneManager
+
+
+class CoppeliaSession:
+    """A thread-safe connection to a CoppeliaSim instance that can be shared between modules.
+
+    A RemoteAPIClient wraps a single ZMQ socket that must not be used by more than one thread at a time. A session
+    holds a small pool of clients, and every remote call made through session.sim borrows one client for the duration
+    of the call, so calls from the camera thread and from retico worker threads never interleave on the same socket.
+
+    Example:\n
+    session = CoppeliaSession.shared()\n
+    coppelia = CoppeliaModule(scene=scene, session=session)\n
+    cam = CoppeliaCameraModule(scene=scene, sensor_path=sensor_path, session=session)
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, host='localhost', port=23000, pool_size=1, client_factory=RemoteAPIClient):
+        """
+        :param host: The host CoppeliaSim's ZMQ remote API server is running on.
+        :param port: The port of the remote API server.
+        :param pool_size: The number of clients to open. Calls from different threads only run concurrently with a
+        pool_size greater than 1. Stepping mode is bound to a single client, so use a pool_size of 1 for sessions that
+        are stepped by a CoppeliaStepScheduler.
+        :param client_factory: The class used to create the clients.
+        """
+        self.host = host
+        self.port = port
+        self._clients = [client_factory(host, port) for _ in range(pool_size)]
+        self._pool = queue.LifoQueue()
+        for client in self._clients:
+            self._pool.put(client)
+        self._proxies = {}
+        self._objects = {}  # name -> {client: remote object}
+        self.sim = self.require('sim')
+        self.scenes = SceneManager(self.sim)
+
+    @classmethod
+    def shared(cls, host='localhost', port=23000, pool_size=1):
+        """Returns the session for host and port that is shared within this process, creating it on first use.
+
+        :param host: The host CoppeliaSim's ZMQ remote API server is running on.
+        :param port: The port of the remote API server.
+        :param pool_size: The number of clients to open if the session has to be created.
+        :return: A CoppeliaSession.
+        """
+        with cls._shared_lock:
+            session = cls._shared.get((host, port))
+            if session is None:
+                session = cls(host, port, pool_size)
+                cls._shared[(host, port)] = session
+        return session
+
+    def require(self, name):
+        """Returns a thread-safe proxy for a remote API object such as 'sim'.
+
+        :param name: The name of the object, as passed to RemoteAPIClient.require().
+        """
+        proxy = self._proxies.get(name)
+        if proxy is None:
+            # RemoteAPIClient.require() asks the server for the object's functions every time it is called, so each
+            # client resolves it once here
+            self._objects[name] = {client: client.require(name) for client in self._clients}
+            proxy = _RemoteObjectProxy(self, name)
+            self._proxies[name] = proxy
+        return proxy
+
+    @contextmanager
+    def client(self):
+        """Borrows a client for exclusive use by the calling thread, e.g. to make several calls back to back.
+
+        Example:\n
+        with session.client() as client:\n
+            sim = session.object_for(client, 'sim')\n
+            ...
+        """
+        client = self._pool.get()
+        try:
+            yield client
+        finally:
+            self._pool.put(client)
+
+    def object_for(self, client, name):
+        """Returns the remote API object name as resolved by client, without another round trip to the server."""
+        self.require(name)
+        return self._objects[name][client]
+
+    def __len__(self):
+        return len(self._clients)
+
+
+class _RemoteObjectProxy:
+    """Forwards attribute access to a remote API object, borrowing a client from the session for every call."""
+
+    def __init__(self, session, name):
+        self._session = session
+        self._name = name
+        self._objects = session._objects[name]
+        self._template = self._objects[session._clients[0]]
+
+    def __getattr__(self, attr):
+        value = getattr(self._template, attr)
+        if not callable(value):
+            return value
+
+        session, objects = self._session, self._objects
+
+        def call(*args, **kwargs):
+            with session.client() as client:
+                return getattr(objects[client], attr)(*args, **kwargs)
+
+        # Cache the wrapper so that __getattr__ is only hit once per function
+        setattr(self, attr, call)
+        return call
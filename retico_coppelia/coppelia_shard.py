@@ -0,0 +1,180 @@
+import copy
+import subprocess
+import threading
+import zlib
+import retico_core
+from coppeliasim_zmqremoteapi_client import RemoteAPIClient
+from retico_coppelia.coppelia_session import CoppeliaSession
+
+
+def parse_endpoint(endpoint):
+    """Turns 'host:port', 'port' or (host, port) into a (host, port) tuple."""
+    if isinstance(endpoint, (tuple, list)):
+        return endpoint[0], int(endpoint[1])
+    if isinstance(endpoint, int):
+        return 'localhost', endpoint
+    host, _, port = str(endpoint).rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class CoppeliaShards:
+    """Spreads robots, scenes or vision sensors across several CoppeliaSim instances, each running its own physics,
+    rendering and remote API server, so that a pipeline is not limited to what a single simulator process can do.
+
+    Each key (e.g. a robot path, a scene or an episode id) is assigned to one shard and always gets the same shard's
+    session, so all modules working on the same key talk to the same simulator.
+
+    Example:\n
+    shards = CoppeliaShards(['localhost:23000', 'localhost:23002', 'simhost:23000'])\n
+    cozmo_a = CoppeliaCozmoModule('/cozmo', scene, session=shards.session_for('episode-a'))\n
+    cozmo_b = CoppeliaCozmoModule('/cozmo', scene, session=shards.session_for('episode-b'))
+    """
+
+    def __init__(self, endpoints, pool_size=1, client_factory=RemoteAPIClient, strategy='hash'):
+        """
+        :param endpoints: The simulator instances, as 'host:port' strings or (host, port) tuples.
+        :param pool_size: The pool_size of each shard's CoppeliaSession.
+        :param client_factory: The class used to create the remote API clients.
+        :param strategy: How keys without an explicit assignment are placed: 'hash' picks the shard from a CRC32 of
+        the key, which is the same in every process, and 'round_robin' assigns keys to the shards in turn, in the
+        order they are first seen.
+        """
+        if strategy not in ('hash', 'round_robin'):
+            raise Exception(f"Invalid sharding strategy {strategy}.")
+        if len(endpoints) == 0:
+            raise Exception("No CoppeliaSim endpoints specified.")
+
+        self.endpoints = [parse_endpoint(endpoint) for endpoint in endpoints]
+        self.sessions = [CoppeliaSession(host, port, pool_size, client_factory) for host, port in self.endpoints]
+        self.strategy = strategy
+        self.processes = []
+        self._assignments = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def launch(cls, n, executable='coppeliaSim.sh', base_port=23000, args=('-h',), **kwargs):
+        """Starts n headless CoppeliaSim instances on this machine and returns the shards for them. Each instance
+        serves its remote API on base_port + 2 * i (the port after it is used by the remote API as well). Call
+        close() to terminate the instances.
+
+        :param n: The number of instances.
+        :param executable: The CoppeliaSim launcher.
+        :param base_port: The remote API port of the first instance.
+        :param args: Further command line arguments for every instance, by default '-h' for headless mode.
+        :param kwargs: Passed on to CoppeliaShards().
+        """
+        processes = []
+        ports = [base_port + 2 * i for i in range(n)]
+        for port in ports:
+            command = [executable, *args, f"-GzmqRemoteApi.rpcPort={port}", f"-GzmqRemoteApi.cntPort={port + 1}"]
+            processes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+        try:
+            # Creating the sessions blocks until every instance answers
+            shards = cls([('localhost', port) for port in ports], **kwargs)
+        except Exception:
+            for process in processes:
+                process.terminate()
+            raise
+        shards.processes = processes
+        return shards
+
+    def assign(self, key, shard):
+        """Pins key to the shard with the given index."""
+        if not 0 <= shard < len(self.sessions):
+            raise Exception(f"There is no shard {shard}.")
+        with self._lock:
+            self._assignments[key] = shard
+
+    def shard_of(self, key):
+        """Returns the index of the shard key is assigned to, assigning it on first use."""
+        with self._lock:
+            shard = self._assignments.get(key)
+            if shard is None:
+                if self.strategy == 'hash':
+                    shard = zlib.crc32(str(key).encode()) % len(self.sessions)
+                else:
+                    shard = self._next % len(self.sessions)
+                    self._next += 1
+                self._assignments[key] = shard
+        return shard
+
+    def session_for(self, key):
+        """Returns the CoppeliaSession of the shard key is assigned to."""
+        return self.sessions[self.shard_of(key)]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def close(self):
+        """Terminates the instances started by launch()."""
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        self.processes = []
+
+
+class ShardRouterModule(retico_core.AbstractModule):
+    """Forwards each incoming IU only to the modules registered for its key, e.g. the CoppeliaCozmoModule controlling
+    the robot the IU is meant for, which may be running on another shard. IUs whose key has no route are passed on to
+    the module's regular subscribers.
+
+    Example:\n
+    router = ShardRouterModule(key=lambda iu: iu.meta_data.get('robot'))\n
+    router.route('cozmo-a', cozmo_a)\n
+    router.route('cozmo-b', cozmo_b)\n
+    commands.subscribe(router)
+    """
+
+    @staticmethod
+    def name():
+        return "Shard Router Module"
+
+    @staticmethod
+    def description():
+        return "A module that routes IUs to the modules of the shard they belong to"
+
+    @staticmethod
+    def input_ius():
+        return [retico_core.IncrementalUnit]
+
+    @staticmethod
+    def output_iu():
+        return retico_core.IncrementalUnit
+
+    def __init__(self, key=None, **kwargs):
+        """
+        :param key: A function returning the routing key of an IU. By default, the IU's meta_data['shard'].
+        """
+        super().__init__(**kwargs)
+        self.key = key if key is not None else (lambda iu: iu.meta_data.get('shard'))
+        self._routes = {}
+        self.routed = 0
+        self.unrouted = 0
+
+    def route(self, key, module):
+        """Sends the IUs with the given key to module. A key can be routed to several modules."""
+        q = self.queue_class(self, module)
+        module.add_left_buffer(q)
+        self._routes.setdefault(key, []).append(q)
+
+    def process_update(self, update_message):
+        messages = {}
+        unrouted = retico_core.UpdateMessage()
+        for iu, ut in update_message:
+            key = self.key(iu)
+            if key in self._routes:
+                messages.setdefault(key, retico_core.UpdateMessage()).add_iu(iu, ut)
+                self.routed += 1
+            else:
+                unrouted.add_iu(iu, ut)
+                self.unrouted += 1
+
+        for key, message in messages.items():
+            for q in self._routes[key]:
+                q.put(copy.copy(message))
+        if len(unrouted) > 0:
+            return unrouted
+        return None
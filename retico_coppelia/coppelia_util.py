@@ -0,0 +1,69 @@
+class HandleCache:
+    """Caches the object handles resolved from scene paths, so that repeated commands to the same object don't each
+    cost a sim.getObject() round trip."""
+
+    def __init__(self, sim, paths=None):
+        """
+        :param sim: The 'sim' object of a CoppeliaSim remote API client.
+        :param paths: An optional list of object paths to resolve up front.
+        """
+        self._sim = sim
+        self._handles = {}
+        self.hits = 0
+        self.misses = 0
+
+        if paths is not None:
+            self.warm(paths)
+
+    def get(self, path):
+        """Returns the handle of the object at path, resolving it through the simulator on a cache miss.
+
+        :param path: The path of the object within the scene.
+        :return: The object handle.
+        """
+        handle = self._handles.get(path)
+        if handle is None:
+            self.misses += 1
+            handle = self._sim.getObject(path)
+            self._handles[path] = handle
+        else:
+            self.hits += 1
+        return handle
+
+    def warm(self, paths):
+        """Resolves and caches the handles of all given paths that are not cached yet.
+
+        :param paths: A list of object paths.
+        """
+        for path in paths:
+            if path not in self._handles:
+                self._handles[path] = self._sim.getObject(path)
+
+    def invalidate(self, path=None):
+        """Drops cached handles. Must be called whenever the scene is reloaded or an object is removed.
+
+        :param path: The path to drop. If None, the whole cache is cleared.
+        """
+        if path is None:
+            self._handles.clear()
+        else:
+            self._handles.pop(path, None)
+
+    def __contains__(self, path):
+        return path in self._handles
+
+    def __len__(self):
+        return len(self._handles)
+
+
+def define_script_functions(sim, source):
+    """Runs a Lua chunk in the simulator's sandbox script, so that the functions it defines can afterwards be called
+    through sim.callScriptFunction() with the returned script handle.
+
+    :param sim: The 'sim' object of a CoppeliaSim remote API client.
+    :param source: Lua source defining one or more global functions.
+    :return: The handle of the sandbox script the functions were defined in.
+    """
+    script_handle = sim.getScript(sim.scripttype_sandbox)
+    sim.executeScriptString(source, script_handle)
+    return script_handle